@@ -19,13 +19,19 @@ const telemetrySchema = new mongoose.Schema({
     "timestamp": Number
 }, { collection: 'telemetry_data' });
 
-// Store connected SSE clients
+// Store connected SSE clients, keyed by "<database>/<collection>"
 const sseClients = new Map();
 
+// One ingest process can write several satellites' databases; requests pick one with ?dbName=
+const DEFAULT_DB = 'telemetry_db';
+const connectionFor = (dbName) =>
+    !dbName || dbName === DEFAULT_DB ? mongoose.connection : mongoose.connection.useDb(dbName, { useCache: true });
+const clientKey = (dbName, collection) => `${dbName || DEFAULT_DB}/${collection}`;
+
 // API Endpoints
 app.get('/api/collections', async (req, res) => {
     try {
-        const collections = await mongoose.connection.db.listCollections().toArray();
+        const collections = await connectionFor(req.query.dbName).db.listCollections().toArray();
         res.json({ collections: collections.map(col => col.name) });
     } catch (error) {
         console.error('❌ Error fetching collections:', error);
@@ -35,11 +41,40 @@ app.get('/api/collections', async (req, res) => {
 
 app.get('/api/telemetry', async (req, res) => {
     try {
-      const { collection } = req.query;
-      const Model = mongoose.model(collection, telemetrySchema, collection);
+      const { collection, parameter, from, to, dbName } = req.query;
+      const connection = connectionFor(dbName);
+      const limit = Math.min(parseInt(req.query.limit, 10) || 1000, 100000);
+
+      const match = {};
+      if (from || to) {
+        match.tm_received_time = {};
+        if (from) match.tm_received_time.$gte = Number(from);
+        if (to) match.tm_received_time.$lte = Number(to);
+      }
+
+      if (collection.endsWith('_frames')) {
+        // Frame documents hold every parameter of one TM frame; unwind them
+        // back into the per-parameter shape the frontend expects
+        if (parameter) match[`params.${parameter}`] = { $exists: true };
+        const data = await connection.db.collection(collection).aggregate([
+          { $match: match },
+          { $sort: { tm_received_time: 1 } },
+          { $project: { _id: 0, tm_id: 1, tm_received_time: 1, processed_at: 1, local_date_time: 1,
+                        params: { $objectToArray: '$params' } } },
+          { $unwind: '$params' },
+          ...(parameter ? [{ $match: { 'params.k': parameter } }] : []),
+          { $limit: limit },
+          { $project: { tm_id: 1, tm_received_time: 1, processed_at: 1, local_date_time: 1,
+                        parameter: '$params.k', value: '$params.v' } }
+        ]).toArray();
+        return res.json(data);
+      }
+
+      if (parameter) match.parameter = parameter;
+      const Model = connection.models[collection] || connection.model(collection, telemetrySchema, collection);
       
       // Get raw documents without transformation
-      const data = await Model.find().sort({ "tm_received_time": 1 }).limit(1000);
+      const data = await Model.find(match).sort({ "tm_received_time": 1 }).limit(limit);
       
       // Send the raw data exactly as stored in MongoDB
       res.json(data);
@@ -49,10 +84,113 @@ app.get('/api/telemetry', async (req, res) => {
     }
   });
 
+// Rollups kept by the ingester, finest first (bucket width in seconds)
+const ROLLUP_RESOLUTIONS = [['1m', 60], ['10m', 600], ['1h', 3600]];
+
+app.get('/api/telemetry/rollup', async (req, res) => {
+    try {
+      const { parameter, tm_id } = req.query;
+      if (!req.query.collection || !parameter) {
+        return res.status(400).json({ error: 'Missing collection or parameter' });
+      }
+      const base = req.query.collection.replace(/_frames$/, '');
+      const points = Math.min(parseInt(req.query.points, 10) || 300, 5000);
+      const db = connectionFor(req.query.dbName).db;
+
+      const match = { parameter };
+      if (tm_id) match.tm_id = Number(tm_id);
+
+      let from = req.query.from ? Number(req.query.from) : null;
+      let to = req.query.to ? Number(req.query.to) : null;
+      if (from === null || to === null) {
+        // Open-ended ranges take their bounds from the coarsest rollup
+        const coarse = db.collection(`${base}_rollup_1h`);
+        const [first] = await coarse.find(match).sort({ bucket: 1 }).limit(1).toArray();
+        const [last] = await coarse.find(match).sort({ bucket: -1 }).limit(1).toArray();
+        if (!first) return res.json({ resolution: null, data: [] });
+        if (from === null) from = first.bucket;
+        if (to === null) to = last.bucket + 3600;
+      }
+
+      // Finest resolution that still fits the requested number of points
+      const [label, seconds] = ROLLUP_RESOLUTIONS.find(([, width]) => (to - from) / width <= points)
+        || ROLLUP_RESOLUTIONS[ROLLUP_RESOLUTIONS.length - 1];
+      match.bucket = { $gte: from - (from % seconds), $lte: to };
+
+      const data = await db.collection(`${base}_rollup_${label}`).aggregate([
+        { $match: match },
+        { $sort: { bucket: 1 } },
+        { $project: { _id: 0, tm_id: 1, parameter: 1, tm_received_time: '$bucket', count: 1, min: 1, max: 1,
+                      mean: { $divide: ['$sum', '$count'] }, last: '$latest.v' } }
+      ]).toArray();
+      res.json({ resolution: label, data });
+    } catch (error) {
+      console.error('Rollup API Error:', error);
+      res.status(500).json({ error: 'Failed to fetch telemetry rollups' });
+    }
+  });
+
+// Current value of every parameter, answered from the ingester's last-value cache
+const INGESTER_URL = 'http://localhost:9108';
+
+const fetchFromIngester = (path, query) => new Promise((resolve, reject) => {
+    const params = new URLSearchParams(Object.entries(query).filter(([, v]) => v !== undefined && v !== ''));
+    http.get(`${INGESTER_URL}${path}?${params}`, { timeout: 2000 }, (response) => {
+        let body = '';
+        response.on('data', chunk => { body += chunk; });
+        response.on('end', () => {
+            if (response.statusCode !== 200) return reject(new Error(`Status ${response.statusCode}`));
+            try { resolve(JSON.parse(body)); } catch (err) { reject(err); }
+        });
+    }).on('timeout', function () { this.destroy(new Error('timeout')); }).on('error', reject);
+});
+
+app.get('/api/telemetry/latest', async (req, res) => {
+    const { collection, dbName, tm_id, parameter } = req.query;
+    try {
+      return res.json(await fetchFromIngester('/latest', { database: dbName || DEFAULT_DB, collection, tm_id, parameter }));
+    } catch (err) {
+      if (!collection) {
+        return res.status(503).json({ error: 'Ingester not reachable, pass a collection to read the database instead' });
+      }
+      console.warn(`Ingester last values unavailable (${err.message}), reading ${collection} instead`);
+    }
+
+    try {
+      // Fallback while the ingester is down: newest document per (tm_id, parameter)
+      const match = {};
+      if (tm_id) match.tm_id = Number(tm_id);
+      if (parameter) match.parameter = parameter;
+      const data = await connectionFor(dbName).db.collection(collection).aggregate([
+        { $match: match },
+        { $sort: { tm_received_time: -1 } },
+        { $group: { _id: { tm_id: '$tm_id', parameter: '$parameter' }, doc: { $first: '$$ROOT' } } },
+        { $project: { _id: 0, tm_id: '$doc.tm_id', parameter: '$doc.parameter', tm_received_time: '$doc.tm_received_time',
+                      value: '$doc.value', local_date_time: '$doc.local_date_time' } }
+      ], { allowDiskUse: true }).toArray();
+      res.json(data.map(doc => ({ database: dbName || DEFAULT_DB, collection, ...doc })));
+    } catch (error) {
+      console.error('Latest API Error:', error);
+      res.status(500).json({ error: 'Failed to fetch latest telemetry values' });
+    }
+  });
+
+// Rolling mean / std / min / max / slope and active alerts of every parameter, kept by the ingester
+app.get('/api/telemetry/stats', async (req, res) => {
+    const { collection, dbName, tm_id, parameter } = req.query;
+    try {
+      res.json(await fetchFromIngester('/stats', { database: dbName || DEFAULT_DB, collection, tm_id, parameter }));
+    } catch (err) {
+      console.warn(`Ingester stats unavailable: ${err.message}`);
+      res.status(503).json({ error: 'Ingester not reachable' });
+    }
+  });
+
 // SSE Endpoint
 app.get('/api/telemetry/updates', (req, res) => {
-    const { collection } = req.query;
+    const { collection, dbName } = req.query;
     if (!collection) return res.status(400).end();
+    const key = clientKey(dbName, collection);
 
     console.log(`👋 New SSE client connected for collection: ${collection}`);
 
@@ -68,29 +206,29 @@ app.get('/api/telemetry/updates', (req, res) => {
     }, 30000);
 
     // Store the client response object
-    if (!sseClients.has(collection)) {
-        sseClients.set(collection, new Set());
+    if (!sseClients.has(key)) {
+        sseClients.set(key, new Set());
     }
-    sseClients.get(collection).add(res);
+    sseClients.get(key).add(res);
 
     // Remove client when connection closes
     req.on('close', () => {
         clearInterval(pingInterval);
-        if (sseClients.has(collection)) {
-            sseClients.get(collection).delete(res);
-            if (sseClients.get(collection).size === 0) {
-                sseClients.delete(collection);
+        if (sseClients.has(key)) {
+            sseClients.get(key).delete(res);
+            if (sseClients.get(key).size === 0) {
+                sseClients.delete(key);
             }
         }
         console.log(`👋 SSE client disconnected for collection: ${collection}`);
     });
 });
 
-// Function to broadcast updates to SSE clients
-function broadcastUpdate(collection, data) {
-    if (sseClients.has(collection)) {
-        const message = `data: ${JSON.stringify(data)}\n\n`;
-        sseClients.get(collection).forEach(client => {
+// Function to broadcast updates to SSE clients; `event` names the SSE event type (default "message")
+function broadcastUpdate(key, data, event) {
+    if (sseClients.has(key)) {
+        const message = `${event ? `event: ${event}\n` : ''}data: ${JSON.stringify(data)}\n\n`;
+        sseClients.get(key).forEach(client => {
             try {
                 client.write(message);
             } catch (err) {
@@ -102,7 +240,7 @@ function broadcastUpdate(collection, data) {
 
 // MongoDB Connection
 const connectWithRetry = () => {
-    mongoose.connect('mongodb://localhost:27017/telemetry_db', {
+    mongoose.connect(`mongodb://localhost:27017/${DEFAULT_DB}`, {
         serverSelectionTimeoutMS: 5000
     })
     .then(() => {
@@ -136,7 +274,7 @@ const setupChangeStream = async () => {
             changeStream.on('change', change => {
                 const doc = change.fullDocument;
                 // Broadcast the raw document exactly as stored
-                broadcastUpdate(collectionInfo.name, doc);
+                broadcastUpdate(clientKey(DEFAULT_DB, collectionInfo.name), doc);
             });
             
             changeStream.on('error', err => {
@@ -154,14 +292,20 @@ const setupChangeStream = async () => {
 
 // Add this new endpoint for the Python processor to notify about updates
 app.post('/api/notify-update', (req, res) => {
-    const { collection, data } = req.body;
+    const { collection, data, database, events } = req.body;
     if (!collection || !data) {
         return res.status(400).json({ error: 'Missing collection or data' });
     }
     
     // Broadcast each new document to SSE clients
+    const key = clientKey(database, collection);
     data.forEach(doc => {
-        broadcastUpdate(collection, doc);
+        broadcastUpdate(key, doc);
+    });
+
+    // Limit alerts, watched value changes and rolling stats go out as "alert" / "change" / "stats" events
+    (events || []).forEach(event => {
+        broadcastUpdate(key, event, event.type);
     });
     
     res.json({ success: true });
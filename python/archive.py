@@ -0,0 +1,212 @@
+import argparse
+import csv
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from urllib.parse import quote, unquote
+
+ARCHIVE_ROW_GROUP = 8192      # values of one parameter compressed together
+ARCHIVE_FLUSH_INTERVAL = 60   # seconds before partly filled row groups are written anyway
+ROW_GROUP_HEADER = struct.Struct("<2sqqIBII")  # magic, first time, last time, rows, value kind, times bytes, values bytes
+ROW_GROUP_MAGIC = b"RG"
+KIND_INT, KIND_FLOAT, KIND_JSON = 0, 1, 2
+COLUMN_SUFFIX = ".col"
+
+logger = logging.getLogger(__name__)
+
+def column_path(directory, database, collection, tm_id, parameter):
+    return os.path.join(directory, database, collection, str(tm_id), quote(parameter, safe="") + COLUMN_SUFFIX)
+
+def encode_row_group(times, values):
+    # Times are delta coded from the first one, which sits in the header
+    order = sorted(range(len(times)), key=times.__getitem__)
+    times = [times[i] for i in order]
+    values = [values[i] for i in order]
+    deltas = array("q", [0])
+    deltas.extend(b - a for a, b in zip(times, times[1:]))
+
+    kind, encoded = KIND_JSON, None
+    if all(type(v) is int for v in values):
+        try:
+            kind, encoded = KIND_INT, array("q", values).tobytes()
+        except OverflowError:
+            pass
+    elif all(type(v) in (int, float) for v in values):
+        kind, encoded = KIND_FLOAT, array("d", values).tobytes()
+    if encoded is None:
+        kind, encoded = KIND_JSON, json.dumps(values).encode()
+
+    packed_times = zlib.compress(deltas.tobytes())
+    packed_values = zlib.compress(encoded)
+    header = ROW_GROUP_HEADER.pack(ROW_GROUP_MAGIC, times[0], times[-1], len(times), kind,
+                                   len(packed_times), len(packed_values))
+    return header + packed_times + packed_values
+
+class ArchiveWriter:
+    """Appends stored records to compressed per-parameter column files.
+
+    Each (database, collection, tm_id, parameter) gets its own file of row
+    groups: delta coded int64 times and int64 / float64 values (JSON for
+    text), each zlib compressed behind a header with the group's time range.
+    Files are only ever appended to, so a crash costs at most the rows still
+    buffered here.
+    """
+
+    def __init__(self, directory, row_group=ARCHIVE_ROW_GROUP, flush_interval=ARCHIVE_FLUSH_INTERVAL):
+        self.directory = directory
+        self.row_group = row_group
+        self.flush_interval = flush_interval
+        self._columns = {}
+        self._lock = threading.Lock()
+        self._next_flush = time.monotonic() + flush_interval
+
+    def add(self, database, collection, items):
+        with self._lock:
+            columns = self._columns
+            for item in items:
+                if not item["parameter"]:
+                    continue
+                key = (database, collection, item["tm_id"], item["parameter"])
+                column = columns.get(key)
+                if column is None:
+                    column = columns[key] = ([], [])
+                column[0].append(item["tm_received_time"])
+                column[1].append(item["value"])
+                if len(column[0]) >= self.row_group:
+                    self._write(key, columns.pop(key))
+            if time.monotonic() >= self._next_flush:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def _flush(self):
+        self._next_flush = time.monotonic() + self.flush_interval
+        columns, self._columns = self._columns, {}
+        for key, column in columns.items():
+            self._write(key, column)
+
+    def _write(self, key, column):
+        path = column_path(self.directory, *key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "ab") as f:
+                f.write(encode_row_group(*column))
+        except Exception as e:
+            logger.error(f"Archive write error for {path}, {len(column[0])} values lost: {e}")
+
+class ColumnFile:
+    """One memory-mapped column; reads decompress only the row groups that overlap."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.row_groups = self._index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    def _index(self):
+        # Only headers are touched; a torn last group from a crash is ignored
+        groups = []
+        offset, size = 0, len(self._map)
+        while offset + ROW_GROUP_HEADER.size <= size:
+            magic, first, last, rows, kind, times_size, values_size = ROW_GROUP_HEADER.unpack_from(self._map, offset)
+            start = offset + ROW_GROUP_HEADER.size
+            offset = start + times_size + values_size
+            if magic != ROW_GROUP_MAGIC or offset > size:
+                break
+            groups.append((first, last, rows, kind, start, times_size, values_size))
+        return groups
+
+    def _decode(self, first, kind, start, times_size, values_size):
+        times = array("q", zlib.decompress(self._map[start:start + times_size]))
+        running = first
+        for i, delta in enumerate(times):
+            running += delta
+            times[i] = running
+        encoded = zlib.decompress(self._map[start + times_size:start + times_size + values_size])
+        if kind == KIND_JSON:
+            return times, json.loads(encoded)
+        return times, array("q" if kind == KIND_INT else "d", encoded)
+
+    def read(self, start=None, end=None):
+        """Times and values with start <= time <= end, in time order; a time stored twice keeps its last value."""
+        merged = {}
+        for first, last, rows, kind, offset, times_size, values_size in self.row_groups:
+            if (start is not None and last < start) or (end is not None and first > end):
+                continue
+            times, values = self._decode(first, kind, offset, times_size, values_size)
+            for t, value in zip(times, values):
+                if (start is None or t >= start) and (end is None or t <= end):
+                    merged[t] = value
+        times = sorted(merged)
+        return array("q", times), [merged[t] for t in times]
+
+class Archive:
+    """Reader for the column files an ArchiveWriter left in `directory`."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def columns(self):
+        for root, _, files in os.walk(self.directory):
+            parts = os.path.relpath(root, self.directory).split(os.sep)
+            if len(parts) != 3:
+                continue
+            database, collection, tm_id = parts
+            for name in sorted(files):
+                if name.endswith(COLUMN_SUFFIX):
+                    yield database, collection, int(tm_id), unquote(name[:-len(COLUMN_SUFFIX)])
+
+    def read(self, database, collection, tm_id, parameter, start=None, end=None):
+        with ColumnFile(column_path(self.directory, database, collection, tm_id, parameter)) as column:
+            return column.read(start, end)
+
+def main():
+    parser = argparse.ArgumentParser(description="List or export parameters from a telemetry archive")
+    parser.add_argument("archive", help="archive folder of one ingest run")
+    parser.add_argument("--database", default=None, help="database the records were stored in")
+    parser.add_argument("--collection", default=None, help="collection, e.g. eps_telemetry")
+    parser.add_argument("--tm-id", type=int, default=None, help="TM id of the parameter")
+    parser.add_argument("--parameter", default=None, help="parameter to export as CSV; lists columns when left out")
+    parser.add_argument("--from", dest="start", type=int, default=None, help="first tm_received_time")
+    parser.add_argument("--to", dest="end", type=int, default=None, help="last tm_received_time")
+    args = parser.parse_args()
+
+    archive = Archive(args.archive)
+    if args.parameter is None or args.tm_id is None or not args.database or not args.collection:
+        for database, collection, tm_id, parameter in archive.columns():
+            if ((not args.database or database == args.database) and (not args.collection or collection == args.collection)
+                    and (args.tm_id is None or tm_id == args.tm_id)):
+                print(f"{database} {collection} {tm_id} {parameter}")
+        return
+
+    times, values = archive.read(args.database, args.collection, args.tm_id, args.parameter, args.start, args.end)
+    out = csv.writer(sys.stdout)
+    out.writerow(["tm_received_time", "value"])
+    out.writerows(zip(times, values))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
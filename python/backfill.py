@@ -0,0 +1,213 @@
+import argparse
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from telemetry_parser import (TelemetryParser, TelemetryProcessor, FLUSH_BATCH_SIZE, FRAME_INDEX, SECTION_RE,
+                              TM_ID_RE, TM_TIME_RE, LOCAL_TIME_RE, is_header_line)
+from tail_reader import LogTailReader
+from frame_index import FrameIndexWriter, INDEX_HEADER, NO_LINE, UNKNOWN_LINE, fill_lines, index_path
+
+FRAME_MARKER = b"Received TM Id:-"
+MIN_SHARD_BYTES = 4 * 1024 * 1024
+MAX_SHARD_BYTES = 8 * 1024 * 1024  # bounds the records one finished shard holds in the parent
+SHARDS_PER_WORKER = 4
+IN_FLIGHT_PER_WORKER = 2           # shards submitted ahead of the one being stored
+SCAN_BLOCK = 1024 * 1024
+MISSING = object()
+
+logger = logging.getLogger(__name__)
+
+def find_shard_offsets(path, shard_count):
+    # Shard boundaries are the starts of `Received TM Id:-` lines, so every
+    # shard after the first opens on a frame header
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, shard_count):
+            offset = _next_frame_start(f, size * k // shard_count)
+            if offset is None:
+                break
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    offsets.append(size)
+    return offsets
+
+def _next_frame_start(f, offset):
+    base = max(offset - 1, 0)
+    f.seek(base)
+    data = b''
+    search_from = 0 if offset == 0 else None
+    while block := f.read(SCAN_BLOCK):
+        data += block
+        if search_from is None:
+            if (newline := data.find(b'\n')) == -1:
+                continue
+            search_from = newline + 1
+        if (index := data.find(FRAME_MARKER, search_from)) != -1:
+            return base + data.rfind(b'\n', 0, index) + 1
+        # Keep only the last (possibly incomplete) line for the next block
+        cut = max(search_from, data.rfind(b'\n') + 1)
+        base += cut
+        data = data[cut:]
+        search_from = 0
+    return None
+
+def _reverse_lines(f, start, end):
+    position, tail = end, b''
+    while position > start:
+        size = min(SCAN_BLOCK, position - start)
+        position -= size
+        f.seek(position)
+        lines = (f.read(size) + tail).split(b'\n')
+        tail = lines.pop(0) if position > start else b''
+        for raw in reversed(lines):
+            yield raw.decode('utf-8', 'replace')
+
+def _exit_state(parser, f, start, end, entry_state):
+    """Parser state after a sequential run over [start, end), found by scanning backwards.
+
+    Mirrors parse_stream: the header branches are checked in the same order and
+    a section change only counts if the tm_id in effect on that line is truthy.
+    """
+    tm_id = tm_time = local_time = section = pending_section = MISSING
+    for line in _reverse_lines(f, start, end):
+        line = line.strip()
+        if not line:
+            continue
+        if "Received TM Id:-" in line and (match := TM_ID_RE.search(line)):
+            value = int(match.group(1))
+            if tm_id is MISSING:
+                tm_id = value
+            if pending_section is not MISSING:
+                if value:
+                    section = pending_section
+                pending_section = MISSING
+        elif "TM Received Time:-" in line and (match := TM_TIME_RE.search(line)):
+            if tm_time is MISSING:
+                tm_time = match.group(1)
+        elif "TM Recv Local Date and Time:-" in line and (match := LOCAL_TIME_RE.search(line)):
+            if local_time is MISSING:
+                local_time = match.group(1)
+        elif (section is MISSING and pending_section is MISSING and not is_header_line(line)
+              and ("======" in line or SECTION_RE.search(line))):
+            pending_section = parser._section_change(line)
+        if MISSING not in (tm_id, tm_time, local_time, section):
+            break
+
+    entry_tm_id, entry_tm_time, entry_local_time, entry_section = entry_state
+    if pending_section is not MISSING and entry_tm_id:
+        section = pending_section
+    return (entry_tm_id if tm_id is MISSING else tm_id,
+            entry_tm_time if tm_time is MISSING else tm_time,
+            entry_local_time if local_time is MISSING else local_time,
+            entry_section if section is MISSING else section)
+
+def plan_shards(path, shard_count, configs):
+    offsets = find_shard_offsets(path, shard_count)
+    parser = TelemetryParser(configs)
+    state = (None, None, None, None)
+    tasks = []
+    with open(path, 'rb') as f:
+        for start, end in zip(offsets, offsets[1:]):
+            tasks.append((path, start, end, state, configs))
+            state = _exit_state(parser, f, start, end, state)
+    return tasks
+
+def parse_shard(task):
+    path, start, end, state, configs = task
+    parser = TelemetryParser(configs)
+    parser.current_tm_id, parser.current_tm_time, parser.current_local_time, parser.current_section = state
+    reader = LogTailReader(path, start)
+    frame_index = parser.frame_index = FrameIndexWriter(None, reader, parser.current_tm_time)
+    records = [(r["tm_received_time"], r["tm_id"], r["parameter"], r["value"], r["local_date_time"])
+               for r in parser.parse_stream(reader.lines(limit=end))]
+    if reader.read_position == end == os.path.getsize(path) and reader.read_position > reader.offset:
+        records.extend((r["tm_received_time"], r["tm_id"], r["parameter"], r["value"], r["local_date_time"])
+                       for r in parser.parse_stream([reader.take_partial_line()]))
+    return records, bytes(frame_index.buffer), frame_index.lines()
+
+def _in_order(executor, fn, tasks, window):
+    # Like executor.map, but only `window` tasks are submitted ahead of the result being
+    # consumed, so finished shards can't pile up while the writer is behind
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(fn, task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def _open_frame_index(path):
+    try:
+        f = open(index_path(path), "wb")
+        f.write(INDEX_HEADER)
+        return f
+    except OSError as e:
+        logger.error(f"No frame index for {path}: {e}")
+        return None
+
+def backfill(paths, workers=None, database=None):
+    workers = workers or os.cpu_count() or 1
+    processor = TelemetryProcessor(database=database)
+    if not processor.configs:
+        logger.error("No configs loaded, nothing to backfill")
+        processor.close()
+        return 0
+
+    total = 0
+    # Spawned, not forked: the processor already runs writer and metrics threads whose locks a fork would copy
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as executor:
+        for path in paths:
+            start_time = time.time()
+            size = os.path.getsize(path)
+            shard_count = max(1, min(workers * SHARDS_PER_WORKER, size // MIN_SHARD_BYTES), -(-size // MAX_SHARD_BYTES))
+            tasks = plan_shards(path, shard_count, processor.configs)
+            logger.info(f"Backfilling {path}: {size} bytes in {len(tasks)} shards on {workers} workers")
+
+            count = 0
+            frame_index = _open_frame_index(path) if FRAME_INDEX else None
+            lines = (NO_LINE, NO_LINE)
+            # Shards are merged in file order so duplicate keys resolve exactly as a sequential run would
+            for records, shard_frames, shard_lines in _in_order(executor, parse_shard, tasks,
+                                                                workers * IN_FLIGHT_PER_WORKER):
+                if frame_index:
+                    # A shard's first frames start with the section and local time the shard before left
+                    shard_frames = fill_lines(shard_frames, lines)
+                    lines = tuple(line if shard_line == UNKNOWN_LINE else shard_line
+                                  for line, shard_line in zip(lines, shard_lines))
+                    try:
+                        frame_index.write(shard_frames)
+                    except OSError as e:
+                        logger.error(f"Frame index write error for {path}, stopped indexing: {e}")
+                        frame_index.close()
+                        frame_index = None
+                processed_at = int(time.time())
+                for i in range(0, len(records), FLUSH_BATCH_SIZE):
+                    batch = [{"tm_received_time": tm_received_time, "tm_id": tm_id, "parameter": parameter,
+                              "value": value, "processed_at": processed_at, "local_date_time": local_date_time}
+                             for tm_received_time, tm_id, parameter, value, local_date_time
+                             in records[i:i + FLUSH_BATCH_SIZE]]
+                    processor._store_batch(batch, notify=False)
+                count += len(records)
+            if frame_index:
+                frame_index.close()
+
+            elapsed = time.time() - start_time
+            logger.info(f"Backfilled {count} records from {path} in {elapsed:.3f}s ({size / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+            total += count
+    processor.close()
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest existing telemetry logs in parallel")
+    parser.add_argument("logs", nargs="+", help="log files to backfill")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="parser processes (default: CPU count)")
+    parser.add_argument("--database", default=None, help="database to store into (default: DATABASE_NAME)")
+    args = parser.parse_args()
+    backfill(args.logs, args.workers, args.database)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+DEFAULT_FRAMES = 20000
+DEFAULT_MIX = "eps=0.5,obc=0.2,uhf=0.2,other=0.1"
+TOLERANCE = 0.15  # allowed slowdown (and RSS growth) against the baseline before it counts as a regression
+BENCHMARKS = ("parse_line", "process_file", "ingest")
+
+logger = logging.getLogger(__name__)
+
+# Synthetic log generator
+
+def _eps_frame(r, out):
+    for section, unit in (("Panel reading", "A"), ("Conv MPPT reading", "A")):
+        out.append(section)
+        for i in range(5):
+            out.append(f"{i} = [{r.uniform(0, 20):.2f}]V [{r.uniform(-1, 1):.3f}]{unit}")
+    out.append("O/P Conv Volt")
+    for i in range(5):
+        out.append(f"{i} = [{r.uniform(0, 12):.2f}]V")
+    out.append(f"Totl Btry reading = [ {r.uniform(6, 8.4):.3f} ] V [ {r.uniform(-2, 2):.3f} ] A")
+    out.append("EPS Port PWR status:")
+    for channel in ("OBC", "UHF", "ADCS", "S_BAND"):
+        out.append(f"CHNL[{channel}] => PORT[{r.randint(0, 3)}]={r.choice(['ON', 'OFF'])}")
+    out.append("Btry Temprature Sensor Reading")
+    for i in range(8):
+        out.append(f"  Btry temp [{i:02d}] = [{r.uniform(10, 40):.1f}] degC")
+    out.append(f"HRM release status = {r.randint(0, 1)}")
+    out.append(f"Btry_Chrg_Sts = {r.choice(['CHARGING', 'IDLE'])}")
+
+def _obc_frame(r, out):
+    if r.random() < 0.5:
+        out.append(f"CPU LOAD = {r.uniform(0, 100):.1f} %")
+        return
+    for section, kinds in (("ERAM MEMORY", ("TOTAL:", "USED :")), ("EFLASH QSPI MEMORY", ("TOTAL:", "USED:")),
+                           ("FLASH FMC MEMORY", ("TOTAL:", "USED :")), ("IRAM HEAP MEMORY", ("TOTAL :", "REMAINING :")),
+                           ("ERAM HEAP MEMORY", ("TOTAL :", "REMAINING:"))):
+        out.append(r.choice((section, f"====== {section} ======")))
+        for kind in kinds:
+            out.append(f"{kind} {r.randint(1000, 9999999):,} bytes")
+
+def _uhf_frame(r, out):
+    for key in ("up time", "uart1 rx count", "uart0 rx count", "rx mode", "tx mode", "data uart tx cnt"):
+        out.append(f"{key}{r.choice((':', ' =', '=>'))} {r.randint(0, 5000)}")
+    out.append(f"UHF RSSI value in dBm is -{r.randint(50, 120)}")
+
+def _other_frame(r, out):
+    out.append(f"misc value = {r.randint(0, 9)} V")
+    out.append("some free text line")
+
+FRAME_KINDS = {
+    "eps": ((200,), _eps_frame),
+    "obc": ((500, 501), _obc_frame),
+    "uhf": ((800, 819), _uhf_frame),
+    "other": ((999, 700), _other_frame),
+}
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in FRAME_KINDS:
+            raise ValueError(f"Unknown frame kind {kind!r}, expected one of {', '.join(FRAME_KINDS)}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+def generate_log(path, frames=DEFAULT_FRAMES, mix=None, seed=1, start_time=1695712345):
+    """Writes `frames` TM frames in the ingester's log format and returns the line count."""
+    r = random.Random(seed)
+    mix = mix or parse_mix(DEFAULT_MIX)
+    kinds, weights = list(mix), list(mix.values())
+    tm_time = start_time
+    lines = 0
+    with open(path, "w") as f:
+        for n in range(frames):
+            tm_ids, write_frame = FRAME_KINDS[r.choices(kinds, weights)[0]]
+            tm_time += r.choice((0, 1, 1, 2))
+            out = [f"Received TM Id:- {r.choice(tm_ids)}", f"TM Received Time:- {tm_time}",
+                   f"TM Recv Local Date and Time:- 2023-09-26 10:{n // 60 % 60:02d}:{n % 60:02d}"]
+            write_frame(r, out)
+            f.write("\n".join(out) + "\n")
+            lines += len(out)
+    return lines
+
+# In-memory stand-ins for MongoDB and the backend
+
+def _order(value):
+    return tuple(value.values()) if isinstance(value, dict) else value
+
+QUERY_OPERATORS = {
+    "$in": lambda value, operand: value in operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+}
+
+def _matches(document, filter):
+    for field, condition in (filter or {}).items():
+        value = document.get(field)
+        if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            if not all(QUERY_OPERATORS[op](value, operand) for op, operand in condition.items()):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+class MemoryCollection:
+    """The slice of a pymongo Collection the ingester uses, kept in a dict."""
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = f"{database.name}.{name}"
+        self.documents = {}
+        self.indexes = {}
+        self._key_fields = None
+
+    def create_index(self, keys, name=None, **options):
+        self.indexes[name] = {"key": list(keys), **options}
+        if options.get("unique") and self._key_fields is None:
+            self._key_fields = tuple(field for field, _ in keys)
+        return name
+
+    def drop_index(self, name):
+        self.indexes.pop(name, None)
+
+    def index_information(self):
+        return {name: dict(info) for name, info in self.indexes.items()}
+
+    def estimated_document_count(self):
+        return len(self.documents)
+
+    def find(self, filter=None, projection=None):
+        # Projections are ignored, callers only read the fields they asked for
+        return [dict(doc) for doc in self.documents.values() if _matches(doc, filter)]
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        if not self.documents:
+            return None
+        if not sort:
+            return next(iter(self.documents.values()))
+        field, direction = sort[0]
+        choose = max if direction < 0 else min
+        return choose(self.documents.values(), key=lambda doc: _order(doc.get(field)))
+
+    def _key(self, document):
+        if self._key_fields is None:
+            return len(self.documents)
+        return tuple(_order(document.get(field)) for field in self._key_fields)
+
+    def bulk_write(self, requests, ordered=True):
+        result = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0, "upserted": [],
+                  "writeErrors": []}
+        for index, request in enumerate(requests):
+            if isinstance(request, InsertOne):
+                key = self._key(request._doc)
+                if key in self.documents:
+                    result["writeErrors"].append({"index": index, "code": 11000, "errmsg": "duplicate key"})
+                    if ordered:
+                        break
+                    continue
+                self.documents[key] = dict(request._doc)
+                result["nInserted"] += 1
+            elif isinstance(request, UpdateOne):
+                key = self._key(request._filter)
+                document = self.documents.get(key)
+                if document is None:
+                    document = self.documents[key] = dict(request._filter)
+                    result["nUpserted"] += 1
+                    result["upserted"].append({"index": index, "_id": key})
+                    self._apply(document, request._doc)
+                else:
+                    result["nMatched"] += 1
+                    before = deepcopy(document)
+                    self._apply(document, request._doc)
+                    if document != before:
+                        result["nModified"] += 1
+            elif isinstance(request, DeleteOne):
+                self.documents.pop(self._key(request._filter), None)
+            else:
+                raise TypeError(f"Unsupported request {type(request).__name__}")
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def _apply(self, document, update):
+        for operator, fields in update.items():
+            for path, value in fields.items():
+                target = document
+                *parents, field = path.split(".")
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                current = target.get(field)
+                if operator == "$set" or current is None:
+                    target[field] = value
+                elif operator == "$inc":
+                    target[field] = current + value
+                elif operator == "$min":
+                    target[field] = min(current, value, key=_order)
+                elif operator == "$max":
+                    target[field] = max(current, value, key=_order)
+                else:
+                    raise ValueError(f"Unsupported update operator {operator}")
+
+class MemoryDatabase(dict):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def __missing__(self, name):
+        collection = self[name] = MemoryCollection(self, name)
+        return collection
+
+class MemoryClient(dict):
+    def __missing__(self, name):
+        database = self[name] = MemoryDatabase(name)
+        return database
+
+    def close(self):
+        pass
+
+class StubNotifyServer:
+    """Accepts the processor's notify POSTs on a free local port and counts them."""
+
+    def __init__(self):
+        server = self
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                server.requests += 1
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/api/notify-update"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# Benchmarks, each run in a fresh process so peak RSS belongs to it alone
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def bench_parse_line(path):
+    from telemetry_parser import TelemetryParser, TM_ID_RE, TM_TIME_RE, LOCAL_TIME_RE
+    parser = TelemetryParser()
+    calls = []
+    tm_id = tm_time = local_time = None
+    with open(path) as f:
+        for line in f:
+            if match := TM_ID_RE.search(line):
+                tm_id = int(match.group(1))
+            elif match := TM_TIME_RE.search(line):
+                tm_time = match.group(1)
+            elif match := LOCAL_TIME_RE.search(line):
+                local_time = match.group(1)
+            else:
+                calls.append((line, tm_id, tm_time, local_time))
+
+    parse_line = parser.parse_line
+    start_time = time.perf_counter()
+    records = 0
+    for line, tm_id, tm_time, local_time in calls:
+        if parsed := parse_line(line, tm_id, tm_time, local_time):
+            records += len(parsed) if isinstance(parsed, list) else 1
+    return {"lines": len(calls), "records": records, "seconds": time.perf_counter() - start_time}
+
+def _run_processor(path, drain):
+    from telemetry_parser import TelemetryProcessor
+    with StubNotifyServer() as notify_server:
+        client = MemoryClient()
+        processor = TelemetryProcessor(log_file=path, client=client, notification_url=notify_server.url,
+                                       from_start=True)
+        start_time = time.perf_counter()
+        processor.process_file()
+        if drain:
+            processor.close()
+        seconds = time.perf_counter() - start_time
+        if not drain:
+            processor.close()
+        stored = sum(len(c.documents) for db in client.values() for name, c in db.items() if "_rollup_" not in name)
+        return {"lines": processor.reader.lines_read, "records": stored, "seconds": seconds,
+                "notifications": notify_server.requests}
+
+def bench_process_file(path):
+    # Parsing and hand-off only; the writer drains after the clock stops
+    return _run_processor(path, drain=False)
+
+def bench_ingest(path):
+    # Until every record is in the (in-memory) database and the notifier has flushed
+    return _run_processor(path, drain=True)
+
+def _run_benchmark(name, path):
+    import telemetry_parser  # configures logging on import, so quieten it afterwards
+    logging.getLogger().setLevel(logging.WARNING)
+    result = globals()[f"bench_{name}"](path)
+    result["lines_per_second"] = result["lines"] / result["seconds"]
+    result["peak_rss_mb"] = _peak_rss_mb()
+    return result
+
+def run_benchmarks(path, names=BENCHMARKS, repeat=3):
+    results = {}
+    for name in names:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                runs.append(executor.submit(_run_benchmark, name, path).result())
+        best = max(runs, key=lambda run: run["lines_per_second"])
+        best["peak_rss_mb"] = max(run["peak_rss_mb"] for run in runs)
+        results[name] = best
+        logger.info(f"{name}: {best['lines_per_second']:,.0f} lines/s, {best['records']} records, "
+                    f"peak RSS {best['peak_rss_mb']:.1f} MB")
+    return results
+
+def python_version():
+    # Speed moves between minor releases, patch releases are compared as equal
+    return ".".join(platform.python_version_tuple()[:2])
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get("results", {}).get(name)
+        if not reference:
+            continue
+        speed = result["lines_per_second"] / reference["lines_per_second"]
+        memory = result["peak_rss_mb"] / reference["peak_rss_mb"]
+        logger.info(f"{name}: {speed:.2f}x baseline speed, {memory:.2f}x baseline peak RSS")
+        if speed < 1 - tolerance:
+            regressions.append(f"{name} is {(1 - speed) * 100:.0f}% slower than the baseline")
+        if memory > 1 + tolerance:
+            regressions.append(f"{name} uses {(memory - 1) * 100:.0f}% more memory than the baseline")
+    return regressions
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Benchmark the telemetry ingester against a synthetic log")
+    parser.add_argument("--log", help="benchmark this log instead of a generated one")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES, help="TM frames in the generated log")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="frame kinds and weights, e.g. eps=0.5,obc=0.2,uhf=0.3")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the fastest is kept")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    workload = {"log": args.log} if args.log else {"frames": args.frames, "mix": args.mix, "seed": args.seed}
+    python = python_version()
+    baseline = None
+    if not args.save_baseline:
+        if not os.path.exists(args.baseline):
+            logger.info("No baseline stored yet, run with --save-baseline to create one")
+        else:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            # Numbers from another workload or interpreter say nothing about a regression
+            mismatches = [f"{what} {recorded} (now {current})" for what, recorded, current in
+                          (("workload", baseline.get("workload"), workload), ("Python", baseline.get("python"), python))
+                          if recorded != current]
+            if mismatches:
+                logger.error(f"Baseline {args.baseline} was recorded for {', '.join(mismatches)}; "
+                             f"rerun with its options and Python or record a new one with --save-baseline")
+                return 2
+
+    workdir = None
+    try:
+        if args.log:
+            path = args.log
+        else:
+            workdir = tempfile.mkdtemp(prefix="telemetry-bench-")
+            path = os.path.join(workdir, "bench.log")
+            lines = generate_log(path, args.frames, parse_mix(args.mix), args.seed)
+            logger.info(f"Generated {lines} lines ({os.path.getsize(path)} bytes) in {path}")
+        results = run_benchmarks(path, args.only, args.repeat)
+    finally:
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"workload": workload, "python": python, "results": results}, f, indent=2)
+            f.write("\n")
+        logger.info(f"Saved baseline to {args.baseline}")
+        return 0
+    if baseline is None:
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        logger.error(regression)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError, ConnectionFailure
+from storage import LAYOUTS
+from metrics import REGISTRY as metrics
+
+MAX_PENDING_BATCHES = 64        # parser blocks once this many batches are waiting
+FLUSH_INTERVAL = 0.25           # seconds a record may wait for its batch to fill
+MIN_BATCH_SIZE = 500
+MAX_BATCH_SIZE = 20000
+TARGET_WRITE_SECONDS = 0.5      # batch size adapts so one bulk write takes about this long
+WRITE_RETRIES = 3
+MAX_RETRY_DELAY = 5             # seconds between write attempts while spooled records wait for Mongo
+READ_ERROR_DELAY = 1            # seconds before reading the spool again after a failed read
+LATENCY_REPORT_INTERVAL = 30
+DUPLICATE_KEY_ERROR = 11000
+
+logger = logging.getLogger(__name__)
+
+class BulkWriter:
+    """Background stage that turns routed records into large unordered bulk writes.
+
+    The parser hands over batches with put(), which blocks when the writer falls
+    behind instead of dropping data. Records are merged per collection and
+    flushed when the adaptive batch size is reached or FLUSH_INTERVAL expires.
+
+    With a `spool` the batches go through it instead of an in-memory queue: put()
+    only appends, the writer reads the spool in order and acknowledges batches
+    once they are stored, and a write that can't reach Mongo is retried until it
+    is back rather than dropped. A batch Mongo rejects is moved to the spool's
+    quarantine instead, so it can't hold up everything behind it.
+    `resolve(database, collection)` finds the collection of batches left in the
+    spool by an earlier run.
+    """
+
+    def __init__(self, on_written=None, on_stored=None, layout=LAYOUTS["documents"], max_pending=MAX_PENDING_BATCHES,
+                 flush_interval=FLUSH_INTERVAL, cache=None, spool=None, resolve=None):
+        self.on_written = on_written
+        self.on_stored = on_stored
+        self.cache = cache
+        self.spool = spool
+        self.resolve = resolve
+        self.layout = layout
+        self.flush_interval = flush_interval
+        self.batch_size = MIN_BATCH_SIZE
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.latencies = deque(maxlen=2048)
+        self._high_water = {}
+        self._collections = {}
+        self._read_times = {}
+        self._closing = threading.Event()
+        self._failing = False
+        self._last_report = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="bulk-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def put(self, collection, items, notify=True, read_time=None):
+        if self.spool is None:
+            self.queue.put((collection, items, notify, read_time or time.monotonic()))
+            return
+        self._collections[collection.full_name] = collection
+        seq = self.spool.append(collection.database.name, collection.name, items, notify)
+        self._read_times[seq] = read_time or time.monotonic()
+
+    def backlog(self):
+        return self.queue.qsize() if self.spool is None else self.spool.pending()
+
+    def healthy(self):
+        """False while the writer can't read its batches, or once it has stopped unexpectedly."""
+        return self._thread.is_alive() and not self._failing
+
+    def close(self):
+        if self._thread.is_alive():
+            self._closing.set()
+            if self.spool is None:
+                self.queue.put(None)
+            self._thread.join()
+        elif self._thread.ident is not None and not self._closing.is_set():
+            logger.error(f"Bulk writer had stopped, {self.backlog()} batches were not written")
+
+    def _next_entry(self, timeout):
+        # (collection, items, notify, read_time, seq), None once closed and drained, False on timeout
+        if self.spool is None:
+            try:
+                entry = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                return False
+            return entry and (*entry, None)
+        # The spool can't be woken by close(), so it is polled while closing
+        closing = self._closing.is_set()
+        entry = self.spool.get(0 if closing else min(timeout or 0.5, 0.5))
+        if entry is None:
+            return None if closing else False
+        seq, database, name, notify, items = entry
+        full_name = f"{database}.{name}"
+        if full_name not in self._collections:
+            self._collections[full_name] = self.resolve(database, name)
+        return self._collections[full_name], items, notify, self._read_times.pop(seq, time.monotonic()), seq
+
+    def _run(self):
+        try:
+            self._write_loop()
+        except Exception as e:
+            self._failing = True
+            logger.error(f"Bulk writer stopped: {e}")
+            raise
+
+    def _write_loop(self):
+        pending = {}
+        while True:
+            timeout = None
+            if pending:
+                oldest = min(entry[4] for entry in pending.values())
+                timeout = max(0.0, oldest + self.flush_interval - time.monotonic())
+            try:
+                entry = self._next_entry(timeout)
+                self._failing = False
+            except Exception as e:
+                # The spool skips damaged records itself; anything else, e.g. a disk error, is
+                # retried rather than ending the thread while the parser keeps appending
+                self._failing = True
+                metrics.inc("writer_read_errors")
+                if self._closing.is_set():
+                    # Unacknowledged batches, the ones merged here included, are read again next run
+                    logger.error(f"Bulk writer could not read the spool while closing, "
+                                 f"{self.spool.pending()} batches stay in it: {e}")
+                    return
+                logger.error(f"Bulk writer could not read the spool, retrying in {READ_ERROR_DELAY}s: {e}")
+                time.sleep(READ_ERROR_DELAY)
+                continue
+
+            if entry is None:
+                for key in list(pending):
+                    if not self._flush(pending.pop(key)):
+                        return
+                return
+            if entry:
+                collection, items, notify, read_time, seq = entry
+                key = (collection.full_name, notify)
+                if key in pending:
+                    pending[key][1].extend(items)
+                    pending[key][3] = min(pending[key][3], read_time)
+                else:
+                    pending[key] = [collection, list(items), notify, read_time, time.monotonic(), []]
+                if seq is not None:
+                    pending[key][5].append(seq)
+                if len(pending[key][1]) >= self.batch_size and not self._flush(pending.pop(key)):
+                    return
+
+            now = time.monotonic()
+            for key in [k for k, v in pending.items() if now - v[4] >= self.flush_interval]:
+                if not self._flush(pending.pop(key)):
+                    return
+
+    def _flush(self, entry):
+        # False only when spooled records are left for the next run because Mongo is down at close
+        collection, items, notify, read_time, _, seqs = entry
+        if self.cache is not None:
+            # Records stored exactly like this already need no round trip
+            fresh = self.cache.filter(collection, items)
+            if len(fresh) < len(items):
+                metrics.inc("records_unchanged", len(items) - len(fresh))
+            if not fresh:
+                self._ack(seqs)
+                return True
+            items = fresh
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                start_time = time.monotonic()
+                inserted, upserted, modified, matched = self._write(collection, items)
+                elapsed = time.monotonic() - start_time
+                break
+            except ConnectionFailure as e:
+                metrics.inc("write_errors")
+                if self.spool is None:
+                    logger.error(f"Bulk write error for {collection.name} (attempt {attempt}/{WRITE_RETRIES}): {e}")
+                    if attempt >= WRITE_RETRIES:
+                        metrics.inc("records_dropped", len(items))
+                        logger.error(f"Dropping {len(items)} records for {collection.name} "
+                                     f"after {WRITE_RETRIES} failed writes")
+                        return True
+                elif self._closing.is_set():
+                    logger.error(f"Bulk write error for {collection.name} while closing, "
+                                 f"{self.spool.pending()} batches stay in the spool: {e}")
+                    return False
+                else:
+                    logger.error(f"Bulk write error for {collection.name} (attempt {attempt}), "
+                                 f"{self.spool.pending()} batches spooled: {e}")
+                time.sleep(min(0.5 * attempt, MAX_RETRY_DELAY))
+            except Exception as e:
+                # Mongo answered and refused the batch, so writing it again would fail the same way
+                metrics.inc("write_errors")
+                self._reject(collection, items, e)
+                self._ack(seqs)
+                return True
+        self._ack(seqs)
+
+        self._adapt_batch_size(len(items), elapsed)
+        self.latencies.append(time.monotonic() - read_time)
+        metrics.observe("write", elapsed)
+        metrics.observe("ingest_latency", self.latencies[-1])
+        metrics.inc("records_written", len(items))
+        logger.info(f"{collection.name}: Inserted {inserted}, Upserted {upserted}, Modified {modified} in {elapsed:.3f}s")
+        if self.cache is not None:
+            self.cache.update(collection, items)
+        try:
+            if self.on_stored:
+                # Totals kept from the writes only add the keys this write created; keys that
+                # were stored before, maybe by a run that died before its totals were saved,
+                # are passed as `changed` for their totals to be recomputed
+                created, changed = items, []
+                if matched:
+                    keys = {self.layout.key(unit) for unit in matched}
+                    created = [item for item in items if self.layout.key(item) not in keys]
+                    changed = [item for item in items if self.layout.key(item) in keys]
+                self.on_stored(collection, items, created, changed)
+            if notify and self.on_written:
+                self.on_written(collection, items)
+        except Exception as e:
+            logger.error(f"Post-write hook failed for {collection.name}: {e}")
+        self._report_latency()
+        return True
+
+    def _reject(self, collection, items, error):
+        if self.spool is None:
+            metrics.inc("records_dropped", len(items))
+            logger.error(f"Dropping {len(items)} records for {collection.name} rejected by Mongo: {error}")
+            return
+        metrics.inc("records_quarantined", len(items))
+        logger.error(f"Moving {len(items)} records for {collection.name} rejected by Mongo "
+                     f"to the spool quarantine: {error}")
+        try:
+            self.spool.quarantine(collection.database.name, collection.name, items, str(error))
+        except Exception as e:
+            metrics.inc("records_dropped", len(items))
+            logger.error(f"Quarantine write error, dropping {len(items)} records for {collection.name}: {e}")
+
+    def _ack(self, seqs):
+        if seqs:
+            self.spool.ack(seqs)
+
+    def _write(self, collection, items):
+        units = self.layout.group(items)
+        if not units:
+            return 0, 0, 0, []
+        high_water = self._high_water_mark(collection)
+
+        # Nothing stored so far is newer than the high-water mark, so later
+        # keys can be plain inserts; only the rest need an upsert
+        inserts, upserts = [], []
+        for unit in units:
+            (inserts if high_water is None or unit["tm_received_time"] > high_water else upserts).append(unit)
+
+        inserted = upserted = modified = 0
+        if inserts:
+            try:
+                inserted = collection.bulk_write([InsertOne(self.layout.insert_document(unit)) for unit in inserts],
+                                                 ordered=False).inserted_count
+            except BulkWriteError as e:
+                duplicates = [inserts[error["index"]] for error in e.details["writeErrors"]
+                              if error["code"] == DUPLICATE_KEY_ERROR]
+                if len(duplicates) != len(e.details["writeErrors"]):
+                    raise
+                inserted = e.details["nInserted"]
+                upserts.extend(duplicates)
+        matched = []
+        if upserts:
+            result = collection.bulk_write([self.layout.upsert(unit) for unit in upserts], ordered=False)
+            upserted, modified = result.upserted_count, result.modified_count
+            if upserted < len(upserts):
+                created = result.upserted_ids
+                matched = [unit for i, unit in enumerate(upserts) if i not in created]
+
+        newest = max(unit["tm_received_time"] for unit in units)
+        self._high_water[collection.full_name] = newest if high_water is None else max(high_water, newest)
+        return inserted, upserted, modified, matched
+
+    def _high_water_mark(self, collection):
+        name = collection.full_name
+        if name not in self._high_water:
+            # Only documents the unique index covers can clash with an insert, and matching the
+            # index's filter lets the newest one be read from the index instead of a collection scan
+            latest = collection.find_one(self.layout.key_filter, {"tm_received_time": 1},
+                                         sort=[("tm_received_time", -1)])
+            self._high_water[name] = latest["tm_received_time"] if latest else None
+        return self._high_water[name]
+
+    def _adapt_batch_size(self, size, elapsed):
+        if size >= self.batch_size and elapsed < TARGET_WRITE_SECONDS / 2:
+            self.batch_size = min(MAX_BATCH_SIZE, self.batch_size * 2)
+        elif elapsed > TARGET_WRITE_SECONDS:
+            self.batch_size = max(MIN_BATCH_SIZE, self.batch_size // 2)
+
+    def latency_percentiles(self):
+        samples = sorted(self.latencies)
+        if not samples:
+            return None
+        return {"p50": samples[len(samples) // 2], "p95": samples[int(len(samples) * 0.95)], "max": samples[-1]}
+
+    def _report_latency(self):
+        now = time.monotonic()
+        if now - self._last_report >= LATENCY_REPORT_INTERVAL and (stats := self.latency_percentiles()):
+            self._last_report = now
+            logger.info(f"Line to Mongo latency: p50 {stats['p50']:.3f}s, p95 {stats['p95']:.3f}s, "
+                        f"max {stats['max']:.3f}s, batch size {self.batch_size}")
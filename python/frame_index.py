@@ -0,0 +1,236 @@
+import logging
+import mmap
+import os
+import struct
+
+# log offset of the "Received TM Id:-" line, tm_id, TM received time, and the log offsets of the
+# section line and the local time line in effect when the frame starts
+FRAME_RECORD = struct.Struct("<QIqqq")
+OLD_FRAME_RECORD = struct.Struct("<QIq")  # records of indexes written before the header existed
+HEADER = struct.Struct("<4sI")            # magic, format version
+MAGIC = b"FIDX"
+FORMAT_VERSION = 2
+INDEX_HEADER = HEADER.pack(MAGIC, FORMAT_VERSION)
+TIME_FIELD = 12                           # byte position of the time inside a record
+UNKNOWN_TIME = -1
+NO_LINE = -1                              # no such line before the frame, the parser state is None
+UNKNOWN_LINE = -2                         # not known to whoever wrote the record, replay scans back for it
+INDEX_SUFFIX = ".fidx"
+
+logger = logging.getLogger(__name__)
+
+def index_path(log_file):
+    return log_file + INDEX_SUFFIX
+
+def _read_format(f):
+    # Size of the header and the record struct of an open index file
+    header = f.read(HEADER.size)
+    if header == INDEX_HEADER:
+        return HEADER.size, FRAME_RECORD
+    return 0, OLD_FRAME_RECORD if header else FRAME_RECORD
+
+def _upgrade(f):
+    # Rewrites an index without a header in the current format, keeping its frames
+    f.seek(0)
+    data = f.read()
+    data = data[:len(data) - len(data) % OLD_FRAME_RECORD.size]
+    records = (FRAME_RECORD.pack(offset, tm_id, tm_time, UNKNOWN_LINE, UNKNOWN_LINE)
+               for offset, tm_id, tm_time in OLD_FRAME_RECORD.iter_unpack(data))
+    f.seek(0)
+    f.write(INDEX_HEADER + b"".join(records))
+    f.truncate()
+
+def fill_lines(frames, lines):
+    """Gives frames recorded with UNKNOWN_LINE the (section, local time) line offsets `lines` instead.
+
+    Used by backfill, whose shard workers don't know what came before their
+    shard. Returns the patched records.
+    """
+    buffer = bytearray(frames)
+    for position in range(0, len(buffer), FRAME_RECORD.size):
+        offset, tm_id, tm_time, section_line, local_line = FRAME_RECORD.unpack_from(buffer, position)
+        if UNKNOWN_LINE not in (section_line, local_line):
+            # Once a shard has seen both lines, later frames know them too
+            break
+        FRAME_RECORD.pack_into(buffer, position, offset, tm_id, tm_time,
+                               lines[0] if section_line == UNKNOWN_LINE else section_line,
+                               lines[1] if local_line == UNKNOWN_LINE else local_line)
+    return bytes(buffer)
+
+def _frame_time(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return UNKNOWN_TIME
+
+class FrameIndexWriter:
+    """Records where every frame of a log starts while the log is parsed.
+
+    The parser calls start() on a "Received TM Id:-" line, while `reader.offset`
+    still points at that line, timed() on a "TM Received Time:-" line, dated()
+    on a "TM Recv Local Date and Time:-" line and sectioned() on a line that
+    changes the section. A frame is recorded as soon as it starts, with the time
+    the parser would carry over from the frame before and where the section and
+    local time it starts with were read, and its time is patched in place once
+    its own arrives, so a read that stops mid-frame leaves nothing behind.
+    Records stay in memory until flush(); without a `path` they are only
+    collected, e.g. by backfill workers that hand them back to be written in
+    file order.
+
+    `lines` are the offsets of the section and local time lines in effect at the
+    reader's offset, NO_LINE when the read starts at the top of the log and
+    UNKNOWN_LINE otherwise.
+    """
+
+    def __init__(self, path, reader, last_time=None, lines=None):
+        self.path = path
+        self.reader = reader
+        self.buffer = bytearray()
+        self._last_time = _frame_time(last_time)
+        if lines is None:
+            lines = (NO_LINE, NO_LINE) if reader.offset == 0 else (UNKNOWN_LINE, UNKNOWN_LINE)
+        self._section_line, self._local_line = lines
+        self._open = None
+        self._file = None
+        self._flushed = 0
+        if path is not None:
+            self._file = open(path, "r+b" if os.path.exists(path) else "w+b")
+            if _read_format(self._file)[1] is OLD_FRAME_RECORD:
+                logger.info(f"Upgrading the frame index {path}, its frames replay with a backward scan")
+                _upgrade(self._file)
+            self._flushed = self._truncate_from(reader.offset)
+
+    def lines(self):
+        """Offsets of the section and local time lines in effect, for a checkpoint to resume with."""
+        return self._section_line, self._local_line
+
+    def _truncate_from(self, offset):
+        # Frames at or past the starting offset are indexed again as they are read
+        self._file.seek(HEADER.size)
+        data = self._file.read()
+        count = len(data) // FRAME_RECORD.size
+        for i, (frame_offset, *_) in enumerate(FRAME_RECORD.iter_unpack(data[:count * FRAME_RECORD.size])):
+            if frame_offset >= offset:
+                count = i
+                break
+        self._file.seek(0)
+        self._file.write(INDEX_HEADER)
+        self._file.truncate(HEADER.size + count * FRAME_RECORD.size)
+        return count
+
+    def reset(self, offset=0):
+        self.buffer.clear()
+        self._open = None
+        if offset == 0:
+            self._section_line = self._local_line = NO_LINE
+        if self._file is not None:
+            self._flushed = self._truncate_from(offset)
+
+    def start(self, tm_id):
+        self._open = self._flushed + len(self.buffer) // FRAME_RECORD.size
+        self.buffer += FRAME_RECORD.pack(self.reader.offset, tm_id, self._last_time,
+                                         self._section_line, self._local_line)
+
+    def dated(self):
+        self._local_line = self.reader.offset
+
+    def sectioned(self):
+        self._section_line = self.reader.offset
+
+    def timed(self, tm_time):
+        self._last_time = _frame_time(tm_time)
+        if self._open is None:
+            return
+        position = (self._open - self._flushed) * FRAME_RECORD.size + TIME_FIELD
+        if position >= 0:
+            struct.pack_into("<q", self.buffer, position, self._last_time)
+        elif self._file is not None:
+            self._file.seek(HEADER.size + self._open * FRAME_RECORD.size + TIME_FIELD)
+            self._file.write(struct.pack("<q", self._last_time))
+        self._open = None
+
+    def flush(self):
+        if self._file is None or not self.buffer:
+            return
+        try:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(self.buffer)
+            self._file.flush()
+        except OSError as e:
+            logger.error(f"Frame index write error for {self.path}: {e}")
+            return
+        self._flushed += len(self.buffer) // FRAME_RECORD.size
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+
+class FrameIndex:
+    """Memory-mapped view of a log's frame index.
+
+    Frames are (offset, tm_id, time, section line, local time line); an index
+    from before the header existed is read with UNKNOWN_LINE for both lines.
+    """
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        with open(index_path(log_file), "rb") as f:
+            self._start, self._record = _read_format(f)
+            size = os.fstat(f.fileno()).st_size
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.count = (len(self._map) - self._start) // self._record.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    def __len__(self):
+        return self.count
+
+    def frames(self):
+        frames = self._record.iter_unpack(self._map[self._start:self._start + self.count * self._record.size])
+        if self._record is FRAME_RECORD:
+            return frames
+        return ((offset, tm_id, tm_time, UNKNOWN_LINE, UNKNOWN_LINE) for offset, tm_id, tm_time in frames)
+
+    def frame(self, i):
+        record = self._record.unpack_from(self._map, self._start + i * self._record.size)
+        return record if self._record is FRAME_RECORD else (*record, UNKNOWN_LINE, UNKNOWN_LINE)
+
+    def find(self, offset):
+        """The frame starting at log `offset`, or None."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.frame(middle)[0] < offset:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and (frame := self.frame(low))[0] == offset:
+            return frame
+        return None
+
+    def ranges(self, tm_ids=None, start=None, end=None):
+        """Byte ranges (start offset, end offset) covering the matching frames, neighbours merged.
+
+        The end of the last indexed frame isn't known; its range ends at None.
+        """
+        ranges = []
+        in_range = False
+        for offset, tm_id, tm_time, _, _ in self.frames():
+            match = ((tm_ids is None or tm_id in tm_ids) and (start is None or tm_time >= start)
+                     and (end is None or tm_time <= end))
+            if match and not in_range:
+                ranges.append([offset, None])
+            elif in_range and not match:
+                ranges[-1][1] = offset
+            in_range = match
+        return [tuple(r) for r in ranges]
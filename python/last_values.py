@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+
+MAX_CACHED_VALUES = 50000  # (collection, tm_id, parameter) keys kept before the least recently written is evicted
+
+class LastValueCache:
+    """Latest stored (time, value, local time) of every parameter, bounded with LRU eviction.
+
+    The writer asks it which records are already stored exactly as they are, so
+    a repeated or replayed frame costs no Mongo round trip, and tells it what it
+    wrote; only `processed_at` of a skipped record goes stale. The same entries
+    answer "current value of every parameter" without a query.
+    """
+
+    def __init__(self, max_entries=MAX_CACHED_VALUES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def filter(self, collection, items):
+        fresh = []
+        name = collection.full_name
+        with self._lock:
+            entries = self._entries
+            for item in items:
+                cached = entries.get((name, item["tm_id"], item["parameter"]))
+                value = item["value"]
+                if (cached is not None and cached[0] == item["tm_received_time"] and cached[1] == value
+                        and type(cached[1]) is type(value) and cached[2] == item.get("local_date_time")):
+                    continue
+                fresh.append(item)
+        return fresh
+
+    def update(self, collection, items):
+        name = collection.full_name
+        with self._lock:
+            entries = self._entries
+            for item in items:
+                key = (name, item["tm_id"], item["parameter"])
+                cached = entries.get(key)
+                if cached is None or item["tm_received_time"] >= cached[0]:
+                    entries[key] = (item["tm_received_time"], item["value"], item.get("local_date_time"))
+                entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def snapshot(self, database=None, collection=None, tm_id=None, parameter=None):
+        with self._lock:
+            entries = list(self._entries.items())
+        latest = []
+        for (name, key_tm_id, key_parameter), (tm_received_time, value, local_date_time) in entries:
+            db_name, _, collection_name = name.partition(".")
+            if ((database and db_name != database) or (collection and collection_name != collection)
+                    or (tm_id is not None and key_tm_id != tm_id) or (parameter and key_parameter != parameter)):
+                continue
+            latest.append({"database": db_name, "collection": collection_name, "tm_id": key_tm_id,
+                           "parameter": key_parameter, "tm_received_time": tm_received_time,
+                           "value": value, "local_date_time": local_date_time})
+        return latest
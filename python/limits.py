@@ -0,0 +1,294 @@
+import fnmatch
+import json
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+from collections import deque
+from metrics import REGISTRY as metrics
+
+ROLLING_WINDOW = 120        # samples of each parameter the rolling statistics cover
+INSIGHT_INTERVAL = 5        # seconds between rolling statistics sent for a collection
+SLOPE_MIN_SAMPLES = 10      # samples in the window before its slope is checked against max_slope
+LIMITS_CHECK_INTERVAL = 2   # seconds between checks of the *_limits.json files for edits
+LIMITS_SUFFIX = "_limits.json"
+
+logger = logging.getLogger(__name__)
+
+class RollingWindow:
+    """The last `size` samples of one parameter in fixed ring buffers.
+
+    Mean, standard deviation and least-squares slope come from running sums
+    and min / max from monotonic deques, so a sample costs O(1) whatever the
+    window size. Times are kept relative to an origin and the sums are rebuilt
+    once per pass around the ring, so float error can't build up.
+    """
+
+    __slots__ = ("size", "times", "values", "count", "next", "seq", "origin", "last_time",
+                 "sum_t", "sum_v", "sum_tt", "sum_vv", "sum_tv", "lows", "highs")
+
+    def __init__(self, size=ROLLING_WINDOW):
+        self.size = size
+        self.times = array("d", bytes(8 * size))
+        self.values = array("d", bytes(8 * size))
+        self.count = self.next = self.seq = 0
+        self.origin = self.last_time = None
+        self.sum_t = self.sum_v = self.sum_tt = self.sum_vv = self.sum_tv = 0.0
+        self.lows = deque()   # (seq, value), values increasing from the front
+        self.highs = deque()  # (seq, value), values decreasing from the front
+
+    def add(self, t, value):
+        if self.origin is None:
+            self.origin = t
+        x = t - self.origin
+        i = self.next
+        times, values = self.times, self.values
+        sum_t, sum_v, sum_tt, sum_vv, sum_tv = self.sum_t, self.sum_v, self.sum_tt, self.sum_vv, self.sum_tv
+        if self.count == self.size:
+            old_x, old_v = times[i], values[i]
+            sum_t -= old_x
+            sum_v -= old_v
+            sum_tt -= old_x * old_x
+            sum_vv -= old_v * old_v
+            sum_tv -= old_x * old_v
+        else:
+            self.count += 1
+        times[i] = x
+        values[i] = value
+        self.sum_t, self.sum_v = sum_t + x, sum_v + value
+        self.sum_tt, self.sum_vv, self.sum_tv = sum_tt + x * x, sum_vv + value * value, sum_tv + x * value
+
+        seq = self.seq
+        self.seq = seq + 1
+        oldest = seq - self.count + 1
+        lows, highs = self.lows, self.highs
+        while lows and lows[-1][1] >= value:
+            lows.pop()
+        lows.append((seq, value))
+        if lows[0][0] < oldest:
+            lows.popleft()
+        while highs and highs[-1][1] <= value:
+            highs.pop()
+        highs.append((seq, value))
+        if highs[0][0] < oldest:
+            highs.popleft()
+
+        self.last_time = t
+        self.next = i = (i + 1) % self.size
+        if i == 0:
+            self._rebuild()
+
+    def _rebuild(self):
+        shift = min(self.times[:self.count])
+        self.origin += shift
+        self.sum_t = self.sum_v = self.sum_tt = self.sum_vv = self.sum_tv = 0.0
+        for i in range(self.count):
+            x = self.times[i] = self.times[i] - shift
+            v = self.values[i]
+            self.sum_t += x
+            self.sum_v += v
+            self.sum_tt += x * x
+            self.sum_vv += v * v
+            self.sum_tv += x * v
+
+    def mean(self):
+        return self.sum_v / self.count
+
+    def std(self):
+        mean = self.sum_v / self.count
+        return math.sqrt(max(0.0, self.sum_vv / self.count - mean * mean))
+
+    def min(self):
+        return self.lows[0][1]
+
+    def max(self):
+        return self.highs[0][1]
+
+    def slope(self):
+        # Change per second of the least-squares line through the window
+        n = self.count
+        denominator = n * self.sum_tt - self.sum_t * self.sum_t
+        if n < 2 or denominator <= 0:
+            return 0.0
+        return (n * self.sum_tv - self.sum_t * self.sum_v) / denominator
+
+    def last(self):
+        return self.values[(self.next - 1) % self.size]
+
+class ParameterState:
+    __slots__ = ("time", "value", "seen", "window", "rule", "generation", "alerts")
+
+    def __init__(self, rule, generation):
+        self.time = self.value = self.window = None
+        self.seen = False
+        self.rule = rule
+        self.generation = generation
+        self.alerts = {}
+
+class LimitMonitor:
+    """Rolling statistics and limit checks for every parameter as it is parsed.
+
+    Limits are read from <subsystem>_limits.json next to the configs, keyed by
+    parameter name or an fnmatch pattern:
+
+        {"total_battery_voltage": {"min": 6.4, "max": 8.4},
+         "btry_temp_*": {"min": -5, "max": 45, "max_slope": 0.05},
+         "obc_port_*_status": {"on_change": true}}
+
+    `emit(database, collection, events)` gets an "alert" event when a value
+    leaves or re-enters its limits or its slope (per second) passes max_slope,
+    a "change" event when a watched value changes, and "stats" events with the
+    rolling statistics of recently updated parameters every INSIGHT_INTERVAL.
+    """
+
+    def __init__(self, emit, subsystems, window=ROLLING_WINDOW, insight_interval=INSIGHT_INTERVAL):
+        self.emit = emit
+        self.subsystems = subsystems
+        self.window = window
+        self.insight_interval = insight_interval
+        self._params = {}  # (database, collection) -> {(tm_id, parameter): ParameterState}
+        self._updated = {}
+        self._next_insight = {}
+        self._lock = threading.Lock()
+        self._limit_mtimes = self._read_limit_mtimes()
+        self._limits = self._load_limits()
+        self._generation = 0
+        self._next_limits_check = time.monotonic() + LIMITS_CHECK_INTERVAL
+
+    def _read_limit_mtimes(self):
+        mtimes = {}
+        for subsystem in self.subsystems:
+            try:
+                mtimes[subsystem] = os.stat(f"{subsystem}{LIMITS_SUFFIX}").st_mtime_ns
+            except OSError:
+                mtimes[subsystem] = None
+        return mtimes
+
+    def _load_limits(self):
+        limits = {}
+        for subsystem in self.subsystems:
+            path = f"{subsystem}{LIMITS_SUFFIX}"
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path) as f:
+                    rules = json.load(f)
+                limits[subsystem] = ({name: rule for name, rule in rules.items() if not any(c in name for c in "*?[")},
+                                     [(name, rule) for name, rule in rules.items() if any(c in name for c in "*?[")])
+            except Exception as e:
+                logger.error(f"Error loading {path}: {e}")
+        return limits
+
+    def reload_limits_if_changed(self):
+        now = time.monotonic()
+        if now < self._next_limits_check:
+            return
+        self._next_limits_check = now + LIMITS_CHECK_INTERVAL
+        mtimes = self._read_limit_mtimes()
+        if mtimes != self._limit_mtimes:
+            logger.info("Limit files changed, reloading")
+            self._limit_mtimes = mtimes
+            self._limits = self._load_limits()
+            self._generation += 1
+
+    def _rule(self, subsystem, parameter):
+        exact, patterns = self._limits.get(subsystem, ({}, []))
+        rule = exact.get(parameter)
+        if rule is None:
+            rule = next((r for pattern, r in patterns if fnmatch.fnmatchcase(parameter, pattern)), None)
+        return rule
+
+    def check(self, database, collection, subsystem, items):
+        self.reload_limits_if_changed()
+        events = []
+        generation = self._generation
+        with self._lock:
+            params = self._params.setdefault((database, collection), {})
+            updated = self._updated.setdefault((database, collection), set())
+            for item in items:
+                t, value = item["tm_received_time"], item["value"]
+                key = (item["tm_id"], item["parameter"])
+                state = params.get(key)
+                if state is None:
+                    state = params[key] = ParameterState(self._rule(subsystem, key[1]), generation)
+                elif t <= state.time:
+                    # Re-read or replayed records are older than what the window already holds
+                    continue
+                elif state.generation != generation:
+                    state.rule, state.generation = self._rule(subsystem, key[1]), generation
+                previous, state.time, state.value = state.value, t, value
+                rule = state.rule
+
+                if type(value) in (int, float):
+                    window = state.window
+                    if window is None:
+                        window = state.window = RollingWindow(self.window)
+                    window.add(t, value)
+                    updated.add(key)
+                    if rule:
+                        self._check_limits(state, rule, window, item, events)
+                if rule and rule.get("on_change") and state.seen and previous != value:
+                    events.append({"type": "change", "tm_id": key[0], "parameter": key[1],
+                                   "tm_received_time": t, "value": value, "previous": previous})
+                state.seen = True
+            insights = self._insights(database, collection)
+
+        if events:
+            metrics.inc("limit_events", len(events))
+            self.emit(database, collection, events)
+        if insights:
+            self.emit(database, collection, insights)
+
+    def _check_limits(self, state, rule, window, item, events):
+        value = item["value"]
+        low, high, max_slope = rule.get("min"), rule.get("max"), rule.get("max_slope")
+        alerts = state.alerts
+        if low is not None or high is not None:
+            level = "low" if low is not None and value < low else "high" if high is not None and value > high else "ok"
+            # Only transitions are sent, starting from "ok"
+            if alerts.get("limit", "ok") != level:
+                alerts["limit"] = level
+                events.append(_alert(item, "limit", level, min=low, max=high))
+        if max_slope is not None and window.count >= SLOPE_MIN_SAMPLES:
+            slope = window.slope()
+            level = "rising" if slope > max_slope else "falling" if slope < -max_slope else "ok"
+            if alerts.get("slope", "ok") != level:
+                alerts["slope"] = level
+                events.append(_alert(item, "slope", level, slope=slope, max_slope=max_slope))
+
+    def _insights(self, database, collection):
+        target = (database, collection)
+        now = time.monotonic()
+        if now < self._next_insight.get(target, 0):
+            return []
+        self._next_insight[target] = now + self.insight_interval
+        keys, self._updated[target] = self._updated[target], set()
+        params = self._params[target]
+        return [_stats(tm_id, parameter, params[tm_id, parameter].window) for tm_id, parameter in keys]
+
+    def snapshot(self, database=None, collection=None, tm_id=None, parameter=None):
+        """Current rolling statistics and alert states, filtered like LastValueCache.snapshot."""
+        with self._lock:
+            stats = []
+            for (key_database, key_collection), params in self._params.items():
+                if (database and key_database != database) or (collection and key_collection != collection):
+                    continue
+                for (key_tm_id, key_parameter), state in params.items():
+                    if (state.window is None or (tm_id is not None and key_tm_id != tm_id)
+                            or (parameter and key_parameter != parameter)):
+                        continue
+                    stats.append({"database": key_database, "collection": key_collection,
+                                  **_stats(key_tm_id, key_parameter, state.window),
+                                  "alerts": {check: level for check, level in state.alerts.items() if level != "ok"}})
+        return stats
+
+def _alert(item, check, level, **details):
+    return {"type": "alert", "check": check, "state": level, "tm_id": item["tm_id"], "parameter": item["parameter"],
+            "tm_received_time": item["tm_received_time"], "value": item["value"], **details}
+
+def _stats(tm_id, parameter, window):
+    return {"type": "stats", "tm_id": tm_id, "parameter": parameter, "tm_received_time": window.last_time,
+            "n": window.count, "last": window.last(), "mean": window.mean(), "std": window.std(),
+            "min": window.min(), "max": window.max(), "slope": window.slope()}
@@ -0,0 +1,172 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+RATE_WINDOW = 10    # seconds of counter history behind the per-second rates
+PREFIX = "telemetry"
+
+logger = logging.getLogger(__name__)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th sample
+        if not self.count:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return min(bound, self.max)
+        return self.max
+
+class Metrics:
+    """Process-wide counters, latency histograms and gauges for the ingest stages.
+
+    Stages record whole reads, batches and requests rather than single lines, so
+    updates stay off the per-line path. Gauges are callables sampled on export.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+        self._samples = deque([(time.monotonic(), {})])
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def _read_gauges(self):
+        values = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                values[name] = read()
+            except Exception as e:
+                logger.debug("Gauge %s failed: %s", name, e)
+        return values
+
+    def rates(self):
+        # Per-second counter rates over roughly the last RATE_WINDOW seconds
+        now = time.monotonic()
+        with self._lock:
+            counters = dict(self.counters)
+            self._samples.append((now, counters))
+            while len(self._samples) > 2 and now - self._samples[1][0] >= RATE_WINDOW:
+                self._samples.popleft()
+            then, previous = self._samples[0]
+        elapsed = max(now - then, 1e-9)
+        return {name: (value - previous.get(name, 0)) / elapsed for name, value in counters.items()}
+
+    def snapshot(self):
+        rates = self.rates()
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {name: {"count": h.count, "sum": h.sum, "p50": h.quantile(0.5),
+                                 "p95": h.quantile(0.95), "max": h.max}
+                          for name, h in self.histograms.items()}
+        return {"counters": counters,
+                "rates": {f"{name}_per_second": rate for name, rate in rates.items()},
+                "latency_seconds": histograms,
+                "gauges": self._read_gauges()}
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {name: (h.buckets, list(h.counts), h.count, h.sum) for name, h in self.histograms.items()}
+        for name, value in sorted(counters.items()):
+            lines += [f"# TYPE {PREFIX}_{name}_total counter", f"{PREFIX}_{name}_total {value}"]
+        for name, (buckets, counts, count, total) in sorted(histograms.items()):
+            metric = f"{PREFIX}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f'{metric}_bucket{{le="+Inf"}} {count}', f"{metric}_sum {total}", f"{metric}_count {count}"]
+        for name, value in sorted(self._read_gauges().items()):
+            lines += [f"# TYPE {PREFIX}_{name} gauge", f"{PREFIX}_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Metrics()
+
+class MetricsServer:
+    """Serves REGISTRY as Prometheus text on /metrics and as JSON on /metrics.json.
+
+    `routes` maps further paths to callables that take the query parameters as a
+    dict and return something JSON-serialisable.
+    """
+
+    def __init__(self, port, host="127.0.0.1", registry=REGISTRY, routes=None):
+        registry_ = registry
+        routes = dict(routes or {})
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == "/metrics":
+                    body, content_type = registry_.prometheus(), "text/plain; version=0.0.4"
+                elif url.path == "/metrics.json":
+                    body, content_type = json.dumps(registry_.snapshot()), "application/json"
+                elif url.path in routes:
+                    try:
+                        body = json.dumps(routes[url.path](dict(parse_qsl(url.query))))
+                    except ValueError as e:
+                        self.send_error(400, str(e))
+                        return
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics request: " + format, *args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Serving metrics on http://{self.httpd.server_address[0]}:{self.httpd.server_address[1]}/metrics")
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
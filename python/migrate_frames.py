@@ -0,0 +1,85 @@
+import argparse
+import logging
+import time
+from pymongo import MongoClient
+from storage import LAYOUTS, ensure_indexes
+from telemetry_parser import MONGO_URI, DATABASE_NAME, COLLECTION_MAPPING
+
+logger = logging.getLogger(__name__)
+
+def frame_pipeline(target, start=None, end=None):
+    match = {"tm_id": {"$type": "number"}, "parameter": {"$type": "string", "$ne": ""}}
+    if start is not None or end is not None:
+        match["tm_received_time"] = {k: v for k, v in (("$gte", start), ("$lt", end)) if v is not None}
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": {"tm_received_time": "$tm_received_time", "tm_id": "$tm_id"},
+            "local_date_time": {"$last": "$local_date_time"},
+            "processed_at": {"$max": "$processed_at"},
+            "params": {"$push": {"k": "$parameter", "v": "$value"}}
+        }},
+        {"$project": {
+            "_id": 0,
+            "tm_received_time": "$_id.tm_received_time",
+            "tm_id": "$_id.tm_id",
+            "local_date_time": 1,
+            "processed_at": 1,
+            "params": {"$arrayToObject": "$params"}
+        }},
+        # Re-running over a range merges into frames written since instead of replacing them
+        {"$merge": {
+            "into": target,
+            "on": ["tm_received_time", "tm_id"],
+            "whenMatched": [{"$set": {
+                "params": {"$mergeObjects": ["$params", "$$new.params"]},
+                "local_date_time": "$$new.local_date_time",
+                "processed_at": {"$max": ["$processed_at", "$$new.processed_at"]}
+            }}],
+            "whenNotMatched": "insert"
+        }}
+    ]
+
+def migrate(db, source_name, step=None):
+    frames = LAYOUTS["frames"]
+    source = db[source_name]
+    target = db[source_name + frames.suffix]
+    ensure_indexes(target, frames)
+
+    key_filter = LAYOUTS["documents"].key_filter
+    first = source.find_one(key_filter, {"tm_received_time": 1}, sort=[("tm_received_time", 1)])
+    last = source.find_one(key_filter, {"tm_received_time": 1}, sort=[("tm_received_time", -1)])
+    if not first:
+        logger.info(f"{source_name} is empty, nothing to migrate")
+        return
+
+    start_time = time.time()
+    ranges = [(None, None)]
+    if step:
+        bounds = list(range(first["tm_received_time"], last["tm_received_time"] + 1, step))
+        ranges = [(lo, lo + step) for lo in bounds]
+    for lo, hi in ranges:
+        source.aggregate(frame_pipeline(target.name, lo, hi), allowDiskUse=True)
+        if lo is not None:
+            logger.info(f"{source_name}: migrated {lo} - {hi}")
+
+    logger.info(f"{source_name}: {source.estimated_document_count()} documents -> "
+                f"{target.estimated_document_count()} frames in {time.time() - start_time:.1f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy per-parameter telemetry documents into frame documents")
+    parser.add_argument("collections", nargs="*", default=list(COLLECTION_MAPPING.values()),
+                        help="source collections (default: all telemetry collections)")
+    parser.add_argument("--step", type=int, default=None,
+                        help="migrate in tm_received_time slices of this many seconds")
+    args = parser.parse_args()
+
+    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+    try:
+        for name in args.collections:
+            migrate(client[DATABASE_NAME], name, args.step)
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import logging
+import queue
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import REGISTRY as metrics
+
+COALESCE_WINDOW = 0.2       # seconds of updates merged into one request per collection
+MAX_PENDING_UPDATES = 256   # queued write batches before the oldest is dropped
+REQUEST_TIMEOUT = 2
+RETRY_AFTER = 5             # seconds to skip sending after the backend failed
+NOTIFY_FIELDS = ("tm_received_time", "tm_id", "parameter", "value", "local_date_time")
+
+logger = logging.getLogger(__name__)
+
+class BackendNotifier:
+    """Sends coalesced "new data" notifications to the backend from its own thread.
+
+    notify() never blocks: when the queue is full the oldest update is dropped,
+    which only loses values that a newer update in the queue supersedes or
+    follows. Each window sends one request per collection carrying the latest
+    value of every (tm_id, parameter) seen in it, plus every limit event
+    (alert, change, stats) queued for that collection, which are never merged.
+    """
+
+    def __init__(self, url, window=COALESCE_WINDOW, max_pending=MAX_PENDING_UPDATES):
+        self.url = url
+        self.window = window
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.sent = 0
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self._down_until = 0
+        self._thread = threading.Thread(target=self._run, name="backend-notifier", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def notify(self, collection, items, database=None):
+        self._put(((database, collection), items, ()))
+
+    def notify_events(self, collection, events, database=None):
+        self._put(((database, collection), (), events))
+
+    def _put(self, entry):
+        while True:
+            try:
+                self.queue.put_nowait(entry)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                    metrics.inc("notify_dropped")
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        self.session.close()
+
+    def _run(self):
+        running = True
+        while running:
+            entry = self.queue.get()
+            pending = {}
+            deadline = time.monotonic() + self.window
+            while True:
+                if entry is None:
+                    running = False
+                    break
+                self._merge(pending, *entry)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            for (database, collection), (latest, events) in pending.items():
+                self._send(collection, list(latest.values()), database, events)
+
+    def _merge(self, pending, target, items, events):
+        latest, pending_events = pending.setdefault(target, ({}, []))
+        pending_events.extend(events)
+        for item in items:
+            key = (item["tm_id"], item["parameter"])
+            current = latest.get(key)
+            if current is None or item["tm_received_time"] >= current["tm_received_time"]:
+                latest[key] = {field: item.get(field) for field in NOTIFY_FIELDS}
+
+    def _send(self, collection, data, database=None, events=None):
+        if time.monotonic() < self._down_until:
+            self.dropped += 1
+            metrics.inc("notify_dropped")
+            return
+        try:
+            start_time = time.monotonic()
+            payload = {"collection": collection, "data": data}
+            if database:
+                payload["database"] = database
+            if events:
+                payload["events"] = events
+            response = self.session.post(self.url, json=payload, timeout=REQUEST_TIMEOUT)
+            metrics.observe("notify", time.monotonic() - start_time)
+            if response.status_code != 200:
+                metrics.inc("notify_errors")
+                logger.warning(f"Notification failed for {collection}: Status {response.status_code}")
+            else:
+                self.sent += 1
+                metrics.inc("notify_requests")
+                logger.debug("Notified backend for %s with %d values in %.3fs",
+                             collection, len(data), time.monotonic() - start_time)
+        except Exception as e:
+            metrics.inc("notify_errors")
+            self._down_until = time.monotonic() + RETRY_AFTER
+            logger.error(f"Could not send notification for {collection}, pausing for {RETRY_AFTER}s: {e}")
@@ -0,0 +1,116 @@
+import argparse
+import logging
+import os
+import time
+from telemetry_parser import TelemetryParser, TelemetryProcessor, FLUSH_BATCH_SIZE
+from tail_reader import LogTailReader
+from telemetry_parser import LOCAL_TIME_RE
+from frame_index import FrameIndex, FrameIndexWriter, NO_LINE, UNKNOWN_LINE, UNKNOWN_TIME, index_path
+from backfill import _exit_state
+
+logger = logging.getLogger(__name__)
+
+def build_index(log_file):
+    # For logs read before indexing existed: one pass that only looks at frame headers
+    reader = LogTailReader(log_file)
+    parser = TelemetryParser({})
+    parser.frame_index = FrameIndexWriter(index_path(log_file), reader)
+    for _ in parser.parse_stream(reader.lines()):
+        pass
+    parser.frame_index.close()
+
+def _line_at(f, offset):
+    f.seek(offset)
+    return f.readline().decode('utf-8', 'replace').strip()
+
+def _entry_state(parser, f, frame):
+    """Parser state a sequential run starts `frame` with, from the lines its index record points at.
+
+    None when the record doesn't know them, e.g. in an index written before they were stored.
+    """
+    _, tm_id, tm_time, section_line, local_line = frame
+    if UNKNOWN_LINE in (section_line, local_line):
+        return None
+    section = None if section_line == NO_LINE else parser._section_change(_line_at(f, section_line))
+    local_time = None
+    if local_line != NO_LINE and (match := LOCAL_TIME_RE.search(_line_at(f, local_line))):
+        local_time = match.group(1)
+    # The frame's own TM id line comes first, and its time only differs from the one carried over once it is read
+    return tm_id, None if tm_time == UNKNOWN_TIME else str(tm_time), local_time, section
+
+def _range_lines(reader, end):
+    # The last indexed frame has no known end; it stops where the next frame starts
+    for i, line in enumerate(reader.lines(end)):
+        if end is None and i and "Received TM Id:-" in line:
+            return
+        yield line
+
+def replay(log_file, tm_ids=None, start=None, end=None, database=None):
+    """Re-parses and stores only the frames of `tm_ids` received between `start` and `end`."""
+    if not os.path.exists(index_path(log_file)):
+        logger.info(f"No frame index for {log_file} yet, building it")
+        build_index(log_file)
+    with FrameIndex(log_file) as index:
+        ranges = index.ranges(set(tm_ids) if tm_ids else None, start, end)
+        entries = [index.find(first) for first, _ in ranges]
+
+    processor = TelemetryProcessor(log_file, database=database)
+    if not processor.configs:
+        logger.error("No configs loaded, nothing to replay")
+        processor.close()
+        return 0
+
+    start_time = time.time()
+    parser = TelemetryParser(processor.configs)
+    count = bytes_read = 0
+    state, previous_end = (None, None, None, None), 0
+    scanned = 0
+    with open(log_file, 'rb') as f:
+        for (first, last), entry in zip(ranges, entries):
+            # A sequential run would arrive here with the section and local time of some earlier
+            # frame, which the index records; without them a backward scan finds them, stopping at
+            # the previous range, whose exit state it starts from
+            if (entry_state := _entry_state(parser, f, entry)) is not None:
+                state = entry_state
+            else:
+                state = _exit_state(parser, f, previous_end, first, state)
+                scanned += 1
+            parser.current_tm_id, parser.current_tm_time, parser.current_local_time, parser.current_section = state
+            reader = LogTailReader(log_file, first)
+            batch = []
+            for record in parser.parse_stream(_range_lines(reader, last)):
+                batch.append(record)
+                if len(batch) >= FLUSH_BATCH_SIZE:
+                    processor._store_batch(batch, notify=False)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                processor._store_batch(batch, notify=False)
+                count += len(batch)
+            bytes_read += reader.offset - first
+            state = (parser.current_tm_id, parser.current_tm_time, parser.current_local_time, parser.current_section)
+            previous_end = reader.offset
+    processor.close()
+
+    logger.info(f"Replayed {count} records from {len(ranges)} frame ranges, {bytes_read} of "
+                f"{os.path.getsize(log_file)} bytes, in {time.time() - start_time:.3f}s")
+    if scanned:
+        logger.info(f"{scanned} ranges had to scan back for their parser state, "
+                    f"--rebuild-index stores it in the index")
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-ingest selected frames of a log using its frame index")
+    parser.add_argument("log", help="log file to replay from")
+    parser.add_argument("--tm-id", type=int, action="append", default=None, help="TM id to replay (repeatable, default: all)")
+    parser.add_argument("--from", dest="start", type=int, default=None, help="first TM received time")
+    parser.add_argument("--to", dest="end", type=int, default=None, help="last TM received time")
+    parser.add_argument("--database", default=None, help="database to store into (default: DATABASE_NAME)")
+    parser.add_argument("--rebuild-index", action="store_true", help="rebuild <log>.fidx from the whole log first")
+    args = parser.parse_args()
+    if args.rebuild_index:
+        build_index(args.log)
+    replay(args.log, args.tm_id, args.start, args.end, args.database)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import logging
+import threading
+import time
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import ServerSelectionTimeoutError
+from storage import LAYOUTS
+from metrics import REGISTRY as metrics
+
+ROLLUP_RESOLUTIONS = {"1m": 60, "10m": 600, "1h": 3600}
+ROLLUP_FLUSH_INTERVAL = 5   # seconds between batched rollup upserts
+ROLLUP_INDEX = ("rollup_index", [("parameter", 1), ("tm_id", 1), ("bucket", 1)], {"unique": True})
+
+logger = logging.getLogger(__name__)
+
+def rollup_collection_name(collection_name, label):
+    return f"{collection_name}_rollup_{label}"
+
+class RollupAggregator:
+    """Keeps min/max/sum/count/last per parameter and time bucket for stored records.
+
+    Numeric values are folded into in-memory buckets for every resolution and a
+    background thread flushes them as $inc/$min/$max upserts, so each bucket
+    costs one update per flush however many raw values it absorbed. Readers
+    compute the mean as sum / count.
+
+    Records that were stored before (a backfill or replay over ingested logs, a
+    re-read after a restart) must not be counted twice, and a changed value has
+    to replace the old one, which $inc can't do. Their buckets are rebuilt
+    instead: the finest from the raw collection, the coarser ones from the
+    finest. Rebuilds run on the writer's thread, the only one storing raw
+    records, so no record is both in a rebuilt bucket and still to be added.
+    """
+
+    def __init__(self, layout=LAYOUTS["documents"], resolutions=ROLLUP_RESOLUTIONS, flush_interval=ROLLUP_FLUSH_INTERVAL):
+        self.layout = layout
+        self.resolutions = resolutions
+        self.flush_interval = flush_interval
+        self._buckets = {}
+        self._targets = {}
+        self._indexed = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # (database name, collection name) -> (raw collection, {(parameter, tm_id, finest bucket)})
+        self._stale = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rollup-flusher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self._stale:
+            self._rebuild_stale()
+        self.flush()
+
+    def add(self, database, collection_name, items, changed=(), source=None):
+        """Folds in `items` with newly stored keys; buckets of `changed` ones, which replaced stored values, are rebuilt from `source`."""
+        # Count each stored key once; later records for a key replace earlier ones in the collection
+        latest = {(item["tm_received_time"], item["tm_id"], item["parameter"]): item for item in items}
+        numeric = [item for item in latest.values() if _numeric(item["value"])]
+        if numeric:
+            with self._lock:
+                for label, seconds in self.resolutions.items():
+                    target = (database.name, rollup_collection_name(collection_name, label))
+                    self._targets.setdefault(target, database)
+                    for item in numeric:
+                        t, value = item["tm_received_time"], item["value"]
+                        key = (target, item["parameter"], item["tm_id"], t - t % seconds)
+                        bucket = self._buckets.get(key)
+                        if bucket is None:
+                            self._buckets[key] = [1, value, value, value, t, value]
+                            continue
+                        bucket[0] += 1
+                        bucket[1] += value
+                        if value < bucket[2]:
+                            bucket[2] = value
+                        if value > bucket[3]:
+                            bucket[3] = value
+                        if t >= bucket[4]:
+                            bucket[4], bucket[5] = t, value
+        seconds = self.resolutions[self._finest()]
+        stale = {(item["parameter"], item["tm_id"], item["tm_received_time"] - item["tm_received_time"] % seconds)
+                 for item in changed if item["parameter"]}
+        if stale:
+            self._stale.setdefault((database.name, collection_name), (source, set()))[1].update(stale)
+        if self._stale:
+            self._rebuild_stale()
+
+    def _rebuild_stale(self):
+        with self._flush_lock:
+            # Everything counted so far goes out first, a rebuilt bucket then replaces it
+            self._flush()
+            with self._lock:
+                waiting = {key[0] for key in self._buckets}
+            for (database_name, collection_name), (source, keys) in list(self._stale.items()):
+                if any((database_name, rollup_collection_name(collection_name, label)) in waiting
+                       for label in self.resolutions):
+                    # Buckets kept back by a failed flush would be added on top of the rebuilt ones
+                    continue
+                try:
+                    self._rebuild(source.database, collection_name, source, keys)
+                    metrics.inc("rollup_buckets_rebuilt", len(keys))
+                    del self._stale[database_name, collection_name]
+                except Exception as e:
+                    logger.error(f"Rollup rebuild error for {collection_name}, "
+                                 f"{len(keys)} buckets retried with the next write: {e}")
+
+    def _finest(self):
+        return min(self.resolutions, key=self.resolutions.get)
+
+    def _rebuild(self, database, collection_name, source, keys):
+        finest = self._finest()
+        seconds = self.resolutions[finest]
+        parameters = sorted({parameter for parameter, _, _ in keys})
+        tm_ids = sorted({tm_id for _, tm_id, _ in keys})
+        buckets = {}
+        start, end = min(k[2] for k in keys), max(k[2] for k in keys) + seconds
+        for tm_id, parameter, t, value in self.layout.read_values(source, tm_ids, parameters, start, end):
+            key = (parameter, tm_id, t - t % seconds)
+            if key in keys and _numeric(value):
+                _merge(buckets, key, 1, value, value, value, t, value)
+        self._replace(database, collection_name, finest, keys, buckets)
+
+        finest_collection = database[rollup_collection_name(collection_name, finest)]
+        for label, size in self.resolutions.items():
+            if label == finest:
+                continue
+            coarse = {(parameter, tm_id, start - start % size) for parameter, tm_id, start in keys}
+            query = {"parameter": {"$in": parameters}, "tm_id": {"$in": tm_ids},
+                     "bucket": {"$gte": min(k[2] for k in coarse), "$lt": max(k[2] for k in coarse) + size}}
+            buckets = {}
+            for doc in finest_collection.find(query, {"_id": 0}):
+                key = (doc["parameter"], doc["tm_id"], doc["bucket"] - doc["bucket"] % size)
+                if key in coarse:
+                    latest = doc["latest"]
+                    _merge(buckets, key, doc["count"], doc["sum"], doc["min"], doc["max"], latest["t"], latest["v"])
+            self._replace(database, collection_name, label, coarse, buckets)
+
+    def _replace(self, database, collection_name, label, keys, buckets):
+        target = (database.name, rollup_collection_name(collection_name, label))
+        collection = self._collection(database, target)
+        ops = []
+        for key in keys:
+            parameter, tm_id, start = key
+            selector = {"parameter": parameter, "tm_id": tm_id, "bucket": start}
+            if key not in buckets:
+                # Values that are no longer numeric leave nothing behind
+                ops.append(DeleteOne(selector))
+                continue
+            count, total, low, high, last_time, last = buckets[key]
+            ops.append(UpdateOne(selector, {"$set": {"count": count, "sum": total, "min": low, "max": high,
+                                                     "latest": {"t": last_time, "v": last}}}, upsert=True))
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+
+    def _collection(self, database, target):
+        collection = database[target[1]]
+        if target not in self._indexed:
+            index_name, keys, options = ROLLUP_INDEX
+            collection.create_index(keys, name=index_name, **options)
+            self._indexed.add(target)
+        return collection
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            buckets, self._buckets = self._buckets, {}
+        if not buckets:
+            return
+
+        operations = {}
+        bucket_keys = {}
+        for key, (count, total, low, high, last_time, last) in buckets.items():
+            target, parameter, tm_id, start = key
+            bucket_keys.setdefault(target, []).append(key)
+            operations.setdefault(target, []).append(UpdateOne(
+                {"parameter": parameter, "tm_id": tm_id, "bucket": start},
+                {"$inc": {"count": count, "sum": total},
+                 "$min": {"min": low},
+                 # Embedded documents compare field by field, so this keeps the value with the newest time
+                 "$max": {"max": high, "latest": {"t": last_time, "v": last}}},
+                upsert=True))
+
+        start_time = time.monotonic()
+        for target, ops in operations.items():
+            collection = self._targets[target][target[1]]
+            try:
+                self._collection(self._targets[target], target).bulk_write(ops, ordered=False)
+                metrics.inc("rollup_buckets_flushed", len(ops))
+            except ServerSelectionTimeoutError as e:
+                # Nothing reached the server, so the buckets wait for the next flush
+                self._restore({key: buckets[key] for key in bucket_keys[target]})
+                logger.error(f"Rollup flush error for {collection.name}, keeping {len(ops)} buckets: {e}")
+            except Exception as e:
+                # Re-applying a partly written batch would double count, so it is dropped
+                logger.error(f"Rollup flush error for {collection.name}, {len(ops)} buckets lost: {e}")
+        metrics.observe("rollup_flush", time.monotonic() - start_time)
+        logger.debug("Flushed %d rollup buckets in %.3fs", len(buckets), time.monotonic() - start_time)
+
+    def _restore(self, buckets):
+        with self._lock:
+            for key, bucket in buckets.items():
+                _merge(self._buckets, key, *bucket)
+
+def _numeric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _merge(buckets, key, count, total, low, high, last_time, last):
+    bucket = buckets.get(key)
+    if bucket is None:
+        buckets[key] = [count, total, low, high, last_time, last]
+        return
+    bucket[0] += count
+    bucket[1] += total
+    bucket[2] = min(bucket[2], low)
+    bucket[3] = max(bucket[3], high)
+    # Same order as the $max on {t, v} in the flush
+    if (last_time, last) > (bucket[4], bucket[5]):
+        bucket[4], bucket[5] = last_time, last
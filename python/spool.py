@@ -0,0 +1,372 @@
+import json
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from metrics import REGISTRY as metrics
+
+SEGMENT_BYTES = 64 * 1024 * 1024       # a new segment file is started past this size
+MAX_SPOOL_BYTES = 2 * 1024 * 1024 * 1024  # appends wait for the writer once the spool is this large
+RECENT_ENTRIES = 64                    # batches kept in memory so a writer that keeps up never reads the disk
+ACK_SAVE_INTERVAL = 1                  # seconds between writes of the acknowledged position
+RECORD_HEADER = struct.Struct("<QII")  # seq, payload length, crc32 of the payload
+RESYNC_SEQS = 1024                     # later batches looked for past a damaged record before skipping its segment
+QUARANTINE_FILE = "quarantine.bin"     # batches Mongo rejected, kept with the error for a later look
+
+logger = logging.getLogger(__name__)
+
+def write_json_atomic(path, data):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger.error(f"Ignoring unreadable {path}: {e}")
+        return None
+
+def _intact(data, position, seq=None):
+    # Whether a whole record (with `seq`, if given) with a matching checksum starts at `position`
+    if position + RECORD_HEADER.size > len(data):
+        return False
+    record_seq, length, crc = RECORD_HEADER.unpack_from(data, position)
+    payload = data[position + RECORD_HEADER.size:position + RECORD_HEADER.size + length]
+    return seq in (None, record_seq) and len(payload) == length and zlib.crc32(payload) == crc
+
+def _find_record(data, start, first_seq, last_seq):
+    # (seq, position) of the first intact record from `start` whose seq is in first_seq..last_seq
+    for seq in range(first_seq, min(last_seq, first_seq + RESYNC_SEQS - 1) + 1):
+        marker = struct.pack("<Q", seq)
+        position = data.find(marker, start)
+        while position != -1:
+            if _intact(data, position, seq):
+                return seq, position
+            position = data.find(marker, position + 1)
+    return None
+
+class RecordSpool:
+    """Append-only segment files that routed batches pass through on their way to Mongo.
+
+    append() stores a batch durably and returns its sequence number; the writer
+    takes batches in order with get() and acknowledges them with ack() once they
+    are in Mongo. Segments whose batches are all acknowledged are deleted, and
+    append() blocks once the spool reaches `max_bytes`, so disk use is bounded
+    and an outage only stalls parsing when the spool is full. After a restart
+    everything not acknowledged is handed out again. Batches Mongo rejects are
+    moved aside with quarantine() and read back with quarantined().
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, max_bytes=MAX_SPOOL_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._cond = threading.Condition()
+        self._ack_path = os.path.join(directory, "acked.json")
+        self.acked = (read_json(self._ack_path) or {}).get("seq", 0)
+        self._ack_saved = self.acked
+        self._next_ack_save = 0
+        self._outstanding = set()
+        self._recent = deque()
+        self._segments = []  # [first_seq, path, size]
+        self._handles = {}
+        self._unsynced = set()  # segments appended to since the last sync()
+        self.next_seq = self._recover()
+        self._read_seq = self.acked + 1
+        self._read_segment, self._read_offset = self._locate(self._read_seq)
+        self._closed = False
+        self._full_since = None
+
+    # Recovery
+
+    def _recover(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".seg"))
+        next_seq = self.acked + 1
+        for name in names:
+            path = os.path.join(self.directory, name)
+            self._segments.append([int(name[:-4]), path, os.path.getsize(path)])
+        if self._segments:
+            # Only the last segment can end in a torn write
+            last = self._segments[-1]
+            end, last_seq = self._scan_intact(last)
+            if end < last[2]:
+                logger.warning(f"Truncating torn spool record at {last[1]}:{end}")
+                with open(last[1], "r+b") as f:
+                    f.truncate(end)
+                last[2] = end
+            next_seq = max(next_seq, (last_seq or last[0] - 1) + 1)
+        if next_seq - 1 > self.acked:
+            logger.info(f"Spool holds {next_seq - 1 - self.acked} unwritten batches in {self.size()} bytes")
+        return next_seq
+
+    def _scan(self, path, stop_after=None):
+        # Offset just past the last valid record (or past `stop_after`) and its seq
+        end, last_seq = 0, None
+        with open(path, "rb") as f:
+            while header := f.read(RECORD_HEADER.size):
+                if len(header) < RECORD_HEADER.size:
+                    break
+                seq, length, crc = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                end, last_seq = f.tell(), seq
+                if stop_after is not None and seq >= stop_after:
+                    break
+        return end, last_seq
+
+    def _scan_intact(self, segment):
+        # Like _scan, but past damaged records, which the reader skips; only what follows
+        # the last intact record is torn
+        first_seq, path, _ = segment
+        with open(path, "rb") as f:
+            data = f.read()
+        position, end, last_seq = 0, 0, None
+        while position + RECORD_HEADER.size <= len(data):
+            if _intact(data, position):
+                last_seq, length, _ = RECORD_HEADER.unpack_from(data, position)
+                position = end = position + RECORD_HEADER.size + length
+                continue
+            damaged = first_seq if last_seq is None else last_seq + 1
+            if (found := _find_record(data, position + 1, damaged + 1, damaged + RESYNC_SEQS)) is None:
+                break
+            position = found[1]
+        return end, last_seq
+
+    def _locate(self, seq):
+        # Segment index and offset of the record with `seq`, or of the end of the spool
+        for index, (first_seq, path, size) in enumerate(self._segments):
+            if index + 1 < len(self._segments) and self._segments[index + 1][0] <= seq:
+                continue
+            if seq <= first_seq:
+                return index, 0
+            end, _ = self._scan(path, stop_after=seq - 1)
+            return index, end
+        return 0, 0
+
+    def truncate_after(self, seq):
+        """Drops batches after `seq`, e.g. ones appended after the last checkpoint."""
+        with self._cond:
+            if seq >= self.next_seq - 1:
+                return
+            for segment in [s for s in self._segments if s[0] > seq]:
+                self._close_handle(segment[1])
+                os.remove(segment[1])
+                self._segments.remove(segment)
+            if self._segments:
+                last = self._segments[-1]
+                end, _ = self._scan(last[1], stop_after=seq)
+                self._close_handle(last[1])
+                with open(last[1], "r+b") as f:
+                    f.truncate(end)
+                last[2] = end
+            self.next_seq = seq + 1
+            self.acked = min(self.acked, seq)
+            self._save_ack()
+            self._recent.clear()
+            self._read_seq = min(self._read_seq, self.next_seq)
+            self._read_segment, self._read_offset = self._locate(self._read_seq)
+            logger.info(f"Dropped spooled batches after {seq}, they are re-read from the log")
+
+    # Writing
+
+    def size(self):
+        return sum(segment[2] for segment in self._segments)
+
+    def pending(self):
+        return self.next_seq - 1 - self.acked
+
+    def append(self, database, collection, items, notify=True):
+        payload = pickle.dumps((database, collection, notify, items), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._cond:
+            while self.size() + len(payload) > self.max_bytes and self.pending() and not self._closed:
+                if self._full_since is None:
+                    self._full_since = time.monotonic()
+                    logger.warning(f"Spool full at {self.size()} bytes, waiting for the writer")
+                self._cond.wait(1)
+            if self._full_since is not None:
+                logger.info(f"Spool has room again after {time.monotonic() - self._full_since:.1f}s")
+                self._full_since = None
+
+            seq = self.next_seq
+            if not self._segments or self._segments[-1][2] >= self.segment_bytes:
+                path = os.path.join(self.directory, f"{seq:020d}.seg")
+                self._segments.append([seq, path, 0])
+                self._handle(path)
+                # The new file's directory entry has to survive a crash too
+                fsync_directory(self.directory)
+            segment = self._segments[-1]
+            self._unsynced.add(segment[1])
+            handle = self._handle(segment[1])
+            handle.seek(segment[2])
+            handle.write(RECORD_HEADER.pack(seq, len(payload), zlib.crc32(payload)))
+            handle.write(payload)
+            handle.flush()
+            segment[2] += RECORD_HEADER.size + len(payload)
+            self.next_seq = seq + 1
+
+            self._recent.append((seq, len(self._segments) - 1, segment[2], (database, collection, notify, items)))
+            if len(self._recent) > RECENT_ENTRIES:
+                self._recent.popleft()
+            self._cond.notify_all()
+            return seq
+
+    def sync(self):
+        with self._cond:
+            # A segment finished since the last sync may still have unwritten pages
+            for path in self._unsynced:
+                if os.path.exists(path):
+                    os.fsync(self._handle(path).fileno())
+            self._unsynced.clear()
+
+    def _handle(self, path):
+        if path not in self._handles:
+            self._handles[path] = open(path, "r+b" if os.path.exists(path) else "w+b")
+        return self._handles[path]
+
+    def _close_handle(self, path):
+        if handle := self._handles.pop(path, None):
+            handle.close()
+
+    def quarantine(self, database, collection, items, error):
+        payload = pickle.dumps((database, collection, items, error, time.time()), protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(self.directory, QUARANTINE_FILE), "ab") as f:
+            f.write(RECORD_HEADER.pack(0, len(payload), zlib.crc32(payload)))
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def quarantined(self):
+        """(database, collection, items, error, time) of every quarantined batch."""
+        path = os.path.join(self.directory, QUARANTINE_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            while len(header := f.read(RECORD_HEADER.size)) == RECORD_HEADER.size:
+                _, length, crc = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    logger.warning(f"Ignoring a torn quarantine record in {path}")
+                    return
+                yield pickle.loads(payload)
+
+    # Reading
+
+    def get(self, timeout=None):
+        """Next unread batch as (seq, database, collection, notify, items), or None on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                while self._read_seq >= self.next_seq:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if self._closed or (remaining is not None and remaining <= 0):
+                        return None
+                    self._cond.wait(remaining)
+
+                seq = self._read_seq
+                while self._recent and self._recent[0][0] < seq:
+                    self._recent.popleft()
+                if self._recent and self._recent[0][0] == seq:
+                    _, segment_index, end, (database, collection, notify, items) = self._recent.popleft()
+                    self._read_segment, self._read_offset = segment_index, end
+                elif (entry := self._read_from_disk(seq)) is None:
+                    # Damaged; _read_seq now points past the batches that were lost with it
+                    continue
+                else:
+                    database, collection, notify, items = entry
+                self._read_seq = seq + 1
+                self._outstanding.add(seq)
+                return seq, database, collection, notify, items
+
+    def _read_from_disk(self, seq):
+        # The batch, or None when its record is damaged and reading moved on past it
+        while True:
+            path = self._segments[self._read_segment][1]
+            handle = self._handle(path)
+            handle.seek(self._read_offset)
+            header = handle.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size and self._read_segment + 1 < len(self._segments):
+                self._read_segment, self._read_offset = self._read_segment + 1, 0
+                continue
+            if len(header) == RECORD_HEADER.size:
+                record_seq, length, crc = RECORD_HEADER.unpack(header)
+                payload = handle.read(length)
+                if record_seq == seq and len(payload) == length and zlib.crc32(payload) == crc:
+                    self._read_offset = handle.tell()
+                    return pickle.loads(payload)
+            self._skip_damaged(seq, path)
+            return None
+
+    def _skip_damaged(self, seq, path):
+        # Moves reading to the next intact record after a damaged one, found by its seq and
+        # checksum, or to the next segment; the batches in between can't be recovered
+        handle = self._handle(path)
+        handle.seek(self._read_offset)
+        data = handle.read()
+        segment = self._read_segment
+        last = (self._segments[segment + 1][0] if segment + 1 < len(self._segments) else self.next_seq) - 1
+        found = _find_record(data, 0, seq + 1, last)
+        if found:
+            self._read_seq, self._read_offset = found[0], self._read_offset + found[1]
+        elif segment + 1 < len(self._segments):
+            self._read_seq = self._segments[segment + 1][0]
+            self._read_segment, self._read_offset = segment + 1, 0
+        else:
+            # Nothing readable is left, later appends continue at the end of the segment
+            self._read_seq, self._read_offset = self.next_seq, self._segments[segment][2]
+        lost = self._read_seq - seq
+        metrics.inc("spool_batches_lost", lost)
+        logger.error(f"Spool record {seq} is damaged in {path}, skipping {lost} batches to {self._read_seq}")
+
+    def ack(self, seqs):
+        with self._cond:
+            self._outstanding.difference_update(seqs)
+            self.acked = (min(self._outstanding) if self._outstanding else self._read_seq) - 1
+            # Segments whose every batch is written can go, except the one being appended to;
+            # the acked position is saved first so a restart never looks for a deleted batch
+            if len(self._segments) > 1 and self._segments[1][0] - 1 <= self.acked:
+                self._save_ack()
+            while len(self._segments) > 1 and self._segments[1][0] - 1 <= self.acked:
+                first_seq, path, _ = self._segments.pop(0)
+                self._close_handle(path)
+                os.remove(path)
+                if self._read_segment == 0:
+                    self._read_offset = 0
+                self._read_segment = max(0, self._read_segment - 1)
+                self._recent = deque((s, i - 1, end, entry) for s, i, end, entry in self._recent)
+            if time.monotonic() >= self._next_ack_save:
+                self._save_ack()
+            self._cond.notify_all()
+
+    def _save_ack(self):
+        if self.acked != self._ack_saved:
+            write_json_atomic(self._ack_path, {"seq": self.acked})
+            self._ack_saved = self.acked
+        self._next_ack_save = time.monotonic() + ACK_SAVE_INTERVAL
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._save_ack()
+            for path in list(self._handles):
+                self._close_handle(path)
+            self._cond.notify_all()
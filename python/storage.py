@@ -0,0 +1,116 @@
+import logging
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+PARTIAL_KEYS = {
+    "tm_id": {"$exists": True, "$type": "number"},
+    "parameter": {"$exists": True, "$type": "string"}
+}
+
+class DocumentLayout:
+    """One document per parameter value, the original layout."""
+    name = "documents"
+    suffix = ""
+    # Queries must repeat the partial filter for telemetry_index to serve them
+    key_filter = PARTIAL_KEYS
+    indexes = (
+        ("telemetry_index", [("tm_received_time", 1), ("tm_id", 1), ("parameter", 1)],
+         {"unique": True, "partialFilterExpression": PARTIAL_KEYS}),
+        ("parameter_time_index", [("parameter", 1), ("tm_received_time", 1)], {}),
+    )
+
+    def key(self, record):
+        return record["tm_received_time"], record["tm_id"], record["parameter"]
+
+    def group(self, items):
+        # Later records for the same key win, as they would with sequential upserts
+        return list({self.key(i): i for i in items}.values())
+
+    def read_values(self, collection, tm_ids, parameters, start, end):
+        """(tm_id, parameter, tm_received_time, value) of the stored records with start <= time < end."""
+        query = {"parameter": {"$in": parameters}, "tm_id": {"$in": tm_ids},
+                 "tm_received_time": {"$gte": start, "$lt": end}}
+        projection = {"_id": 0, "tm_id": 1, "parameter": 1, "tm_received_time": 1, "value": 1}
+        for doc in collection.find(query, projection):
+            yield doc["tm_id"], doc["parameter"], doc["tm_received_time"], doc.get("value")
+
+    def insert_document(self, item):
+        return dict(item)
+
+    def upsert(self, item):
+        return UpdateOne({"tm_received_time": item["tm_received_time"],
+                          "tm_id": item["tm_id"],
+                          "parameter": item["parameter"]},
+                         {"$set": item}, upsert=True)
+
+class FrameLayout:
+    """One document per TM frame with every parameter under `params`."""
+    name = "frames"
+    suffix = "_frames"
+    key_filter = {}
+    indexes = (
+        ("frame_index", [("tm_received_time", 1), ("tm_id", 1)], {"unique": True}),
+        ("tm_id_time_index", [("tm_id", 1), ("tm_received_time", 1)], {}),
+    )
+
+    def key(self, record):
+        return record["tm_received_time"], record["tm_id"]
+
+    def group(self, items):
+        frames = {}
+        for item in items:
+            if not item["parameter"]:
+                # An empty name can't be used as a field path under `params`
+                continue
+            key = (item["tm_received_time"], item["tm_id"])
+            if key not in frames:
+                frames[key] = {"tm_received_time": item["tm_received_time"], "tm_id": item["tm_id"],
+                               "local_date_time": item["local_date_time"], "processed_at": item["processed_at"],
+                               "params": {}}
+            frame = frames[key]
+            frame["params"][item["parameter"]] = item["value"]
+            frame["local_date_time"] = item["local_date_time"]
+            frame["processed_at"] = item["processed_at"]
+        return list(frames.values())
+
+    def insert_document(self, frame):
+        return dict(frame, params=dict(frame["params"]))
+
+    def upsert(self, frame):
+        # Parameters are set individually so frames split across batches merge
+        fields = {f"params.{name}": value for name, value in frame["params"].items()}
+        fields["local_date_time"] = frame["local_date_time"]
+        fields["processed_at"] = frame["processed_at"]
+        return UpdateOne({"tm_received_time": frame["tm_received_time"], "tm_id": frame["tm_id"]},
+                         {"$set": fields}, upsert=True)
+
+    def read_values(self, collection, tm_ids, parameters, start, end):
+        query = {"tm_id": {"$in": tm_ids}, "tm_received_time": {"$gte": start, "$lt": end}}
+        projection = {"_id": 0, "tm_id": 1, "tm_received_time": 1, **{f"params.{p}": 1 for p in parameters}}
+        for doc in collection.find(query, projection):
+            for parameter, value in doc.get("params", {}).items():
+                yield doc["tm_id"], parameter, doc["tm_received_time"], value
+
+LAYOUTS = {layout.name: layout for layout in (DocumentLayout(), FrameLayout())}
+
+def _index_matches(existing, keys, options):
+    if [tuple(k) for k in existing["key"]] != [tuple(k) for k in keys]:
+        return False
+    if bool(existing.get("unique")) != bool(options.get("unique")):
+        return False
+    return dict(existing.get("partialFilterExpression") or {}) == dict(options.get("partialFilterExpression") or {})
+
+def ensure_indexes(collection, layout):
+    # Only touches an index when it is missing or its definition changed, so
+    # restarts don't rebuild indexes on large collections
+    existing = collection.index_information()
+    for name, keys, options in layout.indexes:
+        if name in existing:
+            if _index_matches(existing[name], keys, options):
+                logger.debug("Index %s on %s is up to date", name, collection.name)
+                continue
+            logger.info(f"Index {name} on {collection.name} changed, rebuilding")
+            collection.drop_index(name)
+        collection.create_index(keys, name=name, **options)
+        logger.info(f"Created index {name} for {collection.name}")
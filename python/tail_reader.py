@@ -0,0 +1,78 @@
+import os
+import logging
+import time
+
+CHUNK_SIZE = 64 * 1024
+MAX_LINE_BYTES = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+class LogTailReader:
+    """Streams complete lines appended to a log file in fixed-size chunks.
+
+    `offset` only ever points just past the last line handed to the caller,
+    so a line that is still being written is held back until its newline
+    arrives and is never parsed half-finished.
+    """
+
+    def __init__(self, path, offset=0, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.lines_read = 0
+        self.read_seconds = 0.0
+        self._carry = b''
+
+    @property
+    def read_position(self):
+        return self.offset + len(self._carry)
+
+    def reset(self, offset=0):
+        self.offset = offset
+        self._carry = b''
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def has_new_data(self):
+        # A smaller size means the file was truncated, which process_file handles too
+        return self.size() != self.read_position
+
+    def take_partial_line(self):
+        # For finished files whose last line has no trailing newline
+        line, self._carry = self._carry, b''
+        self.offset += len(line)
+        return line.decode('utf-8', 'replace')
+
+    def lines(self, limit=None):
+        # `limit` is an absolute offset the read must not go past. The carry is
+        # only kept when the chunk loop runs to completion; if the consumer stops
+        # early the next call re-reads from `offset` instead.
+        carry, self._carry = self._carry, b''
+        with open(self.path, 'rb') as f:
+            position = self.offset + len(carry)
+            f.seek(position)
+            while True:
+                started = time.perf_counter()
+                chunk = f.read(self.chunk_size if limit is None else max(0, min(self.chunk_size, limit - position)))
+                self.read_seconds += time.perf_counter() - started
+                if not chunk:
+                    break
+                position += len(chunk)
+                data = carry + chunk
+                end = data.rfind(b'\n')
+                if end == -1:
+                    carry = data
+                    if len(data) >= MAX_LINE_BYTES:
+                        logger.warning(f"Line longer than {MAX_LINE_BYTES} bytes at offset {self.offset}, splitting it")
+                        carry = b''
+                        yield data.decode('utf-8', 'replace')
+                        self.offset += len(data)
+                    continue
+                carry = data[end + 1:]
+                lines = data[:end].split(b'\n')
+                for raw in lines:
+                    yield raw.decode('utf-8', 'replace')
+                    self.offset += len(raw) + 1
+                self.lines_read += len(lines)
+        self._carry = carry
@@ -1,12 +1,26 @@
+import glob
 import json
 import re
 import time
 import os
-import requests
 import logging
-from pymongo import MongoClient, UpdateOne
+import threading
+from types import MappingProxyType
+from functools import lru_cache
+from pymongo import MongoClient
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from tail_reader import LogTailReader
+from bulk_writer import BulkWriter
+from storage import LAYOUTS, ensure_indexes
+from notifier import BackendNotifier
+from rollups import RollupAggregator
+from last_values import LastValueCache
+from limits import LimitMonitor
+from archive import ArchiveWriter
+from frame_index import FrameIndexWriter, index_path
+from spool import RecordSpool, read_json, write_json_atomic
+from watch_scheduler import FileWatchScheduler
+from metrics import REGISTRY as metrics, MetricsServer
 
 # Configuration
 LOG_FILE = "/home/xdlinx/Downloads/eps_2.0.6_dbg_btry_vlt_up/26_sep_charge_t1.log"
@@ -18,40 +32,161 @@ COLLECTION_MAPPING = {
     "uhf": "uhf_telemetry",
     "obc": "obc_telemetry"
 }
+STORAGE_LAYOUT = "documents"  # or "frames": one document per TM frame in <collection>_frames
+TM_ID_RANGES = {
+    "eps": range(200, 301),
+    "obc": range(500, 651),
+    "uhf": range(800, 901)
+}
+CONFIG_CHECK_INTERVAL = 2  # seconds between checks of the *_config.json files for edits
+FLUSH_BATCH_SIZE = 5000  # parsed records held in memory before they are written
+SOURCES = [  # logs to follow and the database each one is stored in; paths may be globs
+    {"path": LOG_FILE, "database": DATABASE_NAME},
+    # {"path": "/data/passes/sat2/*.log", "database": "sat2_db"},
+]
+TURN_BYTES = 1024 * 1024  # most a log is read per turn before the next log gets its turn
+SOURCE_SCAN_INTERVAL = 5  # seconds between glob rescans for new log files
+METRICS_PORT = 9108  # /metrics (Prometheus text), /metrics.json, /latest and /stats on localhost, None to disable
+SPOOL_DIR = "spool"  # parsed records wait here until Mongo has them, so outages and restarts lose nothing; None to disable
+CHECKPOINT_INTERVAL = 1  # seconds between saves of the log offsets that match the spool
+FRAME_INDEX = True  # keep <log>.fidx next to each log with the offset, tm_id and time of every frame, for replay.py
+ARCHIVE_DIR = None  # e.g. "archive": also keep stored records as compressed per-parameter columns, one folder per run
+LIMIT_CHECKS = True  # rolling statistics and <subsystem>_limits.json checks on live records, sent to the backend as events
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-class TelemetryProcessor:
-    def __init__(self):
-        self.client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-        self.db = self.client[DATABASE_NAME]
-        self.last_position = os.path.getsize(LOG_FILE) if os.path.exists(LOG_FILE) else 0
-        self.configs = self._load_configs()
-        self._ensure_indexes()
+# Precompiled parsing engine
+SECTION_MARKERS = ("ERAM MEMORY", "EFLASH QSPI MEMORY", "FLASH FMC MEMORY", "IRAM HEAP MEMORY",
+                   "ERAM HEAP MEMORY", "Conv MPPT reading", "Panel reading", "O/P Conv Volt")
+SECTION_RE = re.compile("|".join(re.escape(s) for s in SECTION_MARKERS))
+SECTION_BANNER_RE = re.compile(r'=+|\s+')
+TM_ID_RE = re.compile(r"Received TM Id:-\s*(\d+)")
+TM_TIME_RE = re.compile(r"TM Received Time:-\s*(\d+)")
+LOCAL_TIME_RE = re.compile(r"TM Recv Local Date and Time:-\s*(\d{4}-\d{1,2}-\d{1,2}\s+\d{1,2}:\d{1,2}:\d{1,2})")
+MEMORY_PATTERNS = (
+    (re.compile(r"TOTAL:\s*([\d,]+)\s*bytes"), {
+        "eram": "total_eram_memory_bytes",
+        "eflash": "total_eflash_qspi_memory_bytes",
+        "flash": "total_flash_fmc_memory_bytes"
+    }),
+    (re.compile(r"USED\s*:\s*([\d,]+)\s*bytes"), {
+        "eram": "used_eram_memory_bytes",
+        "eflash": "used_eflash_qspi_memory_bytes",
+        "flash": "used_flash_fmc_memory_bytes"
+    }),
+    (re.compile(r"TOTAL\s*:\s*([\d,]+)\s*bytes"), {
+        "iram": "total_iram_heap_memory_bytes",
+        "eram": "total_eram_heap_memory_bytes"
+    }),
+    (re.compile(r"REMAINING\s*:\s*([\d,]+)\s*bytes"), {
+        "iram": "remaining_iram_heap_memory_bytes",
+        "eram": "remaining_eram_heap_memory_bytes"
+    })
+)
+MEMORY_LEADS = frozenset("TUR")  # first letters of TOTAL / USED / REMAINING
+CONV_VA_RE = re.compile(r"^(\d+)\s*=\s*\[([^\]]+)\]\s*V\s*\[([^\]]+)\]\s*A")
+CONV_V_RE = re.compile(r"^(\d+)\s*=\s*\[([^\]]+)\]\s*V")
+BTRY_TEMP_RE = re.compile(r".*Btry temp\s*\[(\d+)\]\s*=\s*\[?([\d.]+)\]?\s*degC", re.IGNORECASE)
+CHNL_RE = re.compile(r"CHNL\[(.+?)\]\s*=>\s*PORT\[(\d+)\]=(\w+)")
+TOTL_BTRY_RE = re.compile(r"\[\s*(-?[\d.]+)\s*\]\s*V\s*\[\s*(-?[\d.]+)\s*\]\s*A")
+VALUE_TRIM_RE = re.compile(r'^[=>]*\s*|\s*[A-Za-z]+$')
+PARAM_CHARS_RE = re.compile(r'[^a-z0-9_]')
+UNDERSCORES_RE = re.compile(r'_+')
+
+def is_header_line(line):
+    return ("Received TM Id:-" in line or "TM Received Time:-" in line
+            or "TM Recv Local Date" in line or "Encryption" in line)
+
+@lru_cache(maxsize=4096)
+def _clean_parameter_name(name):
+    # The parameter vocabulary is small, so names are cleaned once and reused
+    return UNDERSCORES_RE.sub('_', PARAM_CHARS_RE.sub('_', name.lower().strip())).strip('_')
+
+class ConfigIndex:
+    """Read-only lookup tables built once from the loaded *_config.json contents.
+
+    `routes` maps each configured tm_id to its subsystem and `accepted` maps it
+    to the raw and cleaned parameter names its config lists. A reload builds a
+    new index and swaps it in whole.
+    """
+
+    def __init__(self, configs):
+        self.configs = configs
+        routes, accepted = {}, {}
+        for subsystem, tm_ids in (configs or {}).items():
+            valid_range = TM_ID_RANGES.get(subsystem)
+            for key, params in tm_ids.items():
+                try:
+                    tm_id = int(key)
+                except ValueError:
+                    logger.warning(f"Ignoring non-numeric tm_id {key!r} in {subsystem} config")
+                    continue
+                if valid_range is not None and tm_id not in valid_range:
+                    logger.warning(f"Ignoring tm_id {tm_id} in {subsystem} config: outside the {subsystem} range")
+                    continue
+                routes[tm_id] = subsystem
+                accepted[tm_id] = frozenset(params) | frozenset(_clean_parameter_name(p) for p in params)
+        self.routes = MappingProxyType(routes)
+        self.accepted = MappingProxyType(accepted)
+
+class TelemetryParser:
+    def __init__(self, configs=None):
+        # Only configs read from disk here are watched for edits; a ConfigIndex
+        # can be passed to share one between parsers
+        self._config_mtimes = self._read_config_mtimes() if configs is None else None
+        if isinstance(configs, ConfigIndex):
+            self.index = configs
+        else:
+            self.index = ConfigIndex(configs if configs is not None else self._load_configs())
+        self._next_config_check = time.monotonic() + CONFIG_CHECK_INTERVAL
         self.current_section = None
         self.current_tm_id = None
-        self.memory_patterns = {
-            r"TOTAL:\s*([\d,]+)\s*bytes": {
-                "eram": "total_eram_memory_bytes",
-                "eflash": "total_eflash_qspi_memory_bytes",
-                "flash": "total_flash_fmc_memory_bytes"
-            },
-            r"USED\s*:\s*([\d,]+)\s*bytes": {
-                "eram": "used_eram_memory_bytes",
-                "eflash": "used_eflash_qspi_memory_bytes",
-                "flash": "used_flash_fmc_memory_bytes"
-            },
-            r"TOTAL\s*:\s*([\d,]+)\s*bytes": {
-                "iram": "total_iram_heap_memory_bytes",
-                "eram": "total_eram_heap_memory_bytes"
-            },
-            r"REMAINING\s*:\s*([\d,]+)\s*bytes": {
-                "iram": "remaining_iram_heap_memory_bytes",
-                "eram": "remaining_eram_heap_memory_bytes"
-            }
-        }
+        self.current_tm_time = None
+        self.current_local_time = None
+        self._last_raw_time = self._last_time = None
+        self._debug = logger.isEnabledFor(logging.DEBUG)
+        self.frame_index = None  # a FrameIndexWriter told where each frame starts
+
+    @property
+    def configs(self):
+        return self.index.configs
+
+    def parser_state(self):
+        return {"section": self.current_section, "tm_id": self.current_tm_id,
+                "tm_time": self.current_tm_time, "local_time": self.current_local_time}
+
+    def restore_parser_state(self, state):
+        self.current_section = state.get("section")
+        self.current_tm_id = state.get("tm_id")
+        self.current_tm_time = state.get("tm_time")
+        self.current_local_time = state.get("local_time")
+
+    def _read_config_mtimes(self):
+        mtimes = []
+        for subsystem in COLLECTION_MAPPING:
+            try:
+                mtimes.append(os.stat(f'{subsystem}_config.json').st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def reload_configs_if_changed(self):
+        if self._config_mtimes is None or time.monotonic() < self._next_config_check:
+            return False
+        self._next_config_check = time.monotonic() + CONFIG_CHECK_INTERVAL
+        mtimes = self._read_config_mtimes()
+        if mtimes == self._config_mtimes:
+            return False
+        self._config_mtimes = mtimes
+        configs = self._load_configs()
+        if configs is None:
+            logger.error("Config reload failed, keeping the previous configs")
+            return False
+        self.index = ConfigIndex(configs)
+        logger.info(f"Reloaded configs: {len(self.index.routes)} tm_ids")
+        return True
 
     def _load_configs(self):
         try:
@@ -72,137 +207,77 @@ class TelemetryProcessor:
             logger.error(f"Error loading configs: {e}")
             return None
 
-    def _ensure_indexes(self):
-        for collection in COLLECTION_MAPPING.values():
-            try:
-                if "telemetry_index" in self.db[collection].index_information():
-                    self.db[collection].drop_index("telemetry_index")
-                
-                self.db[collection].create_index(
-                    [("tm_received_time", 1), ("tm_id", 1), ("parameter", 1)],
-                    name="telemetry_index", unique=True,
-                    partialFilterExpression={
-                        "tm_id": {"$exists": True, "$type": "number"},
-                        "parameter": {"$exists": True, "$type": "string"}
-                    }
-                )
-                logger.info(f"Created/recreated index for {collection}")
-            except Exception as e:
-                logger.error(f"Index error for {collection}: {e}")
-
-    def _update_section_context(self, line):
+    def _section_change(self, line):
+        # Section a stripped body line switches to, or None if it leaves it alone
+        if "======" in line:
+            return SECTION_BANNER_RE.sub('', line).lower()
+        if not SECTION_RE.search(line):
+            return None
         if "ERAM MEMORY" in line:
-            self.current_section = "eram"
+            return "eram"
         elif "EFLASH QSPI MEMORY" in line:
-            self.current_section = "eflash"
+            return "eflash"
         elif "FLASH FMC MEMORY" in line:
-            self.current_section = "flash"
+            return "flash"
         elif "IRAM HEAP MEMORY" in line:
-            self.current_section = "iram"
+            return "iram"
         elif "ERAM HEAP MEMORY" in line:
-            self.current_section = "eram"
+            return "eram"
         elif "Conv MPPT reading" in line:
-            self.current_section = "mppt"
+            return "mppt"
         elif "Panel reading" in line:
-            self.current_section = "panel"
-        elif "O/P Conv Volt" in line:
-            self.current_section = "output"
+            return "panel"
+        return "output"
 
     def clean_parameter_name(self, name):
-        return re.sub(r'_+', '_', re.sub(r'[^a-z0-9_]', '_', name.lower().strip())).strip('_')
+        return _clean_parameter_name(name)
 
     def clean_value(self, value):
-        value = re.sub(r'^[=>]*\s*|\s*[A-Za-z]+$', '', str(value).strip())
+        value = VALUE_TRIM_RE.sub('', str(value).strip())
         try:
             return float(value) if '.' in value else int(value)
         except (ValueError, TypeError):
             return value if value else None
 
+    def _record(self, tm_id, tm_received_time, local_date_time, parameter, value):
+        return {"tm_received_time": tm_received_time, "tm_id": int(tm_id),
+                "parameter": parameter, "value": value,
+                "processed_at": int(time.time()), "local_date_time": local_date_time}
+
     def _parse_memory_data(self, line, tm_id, tm_received_time, local_date_time):
-        for pattern, param_map in self.memory_patterns.items():
-            if match := re.match(pattern, line):
-                for section, param in param_map.items():
-                    if self.current_section == section:
-                        if str(tm_id).startswith('5'):
-                            param = param.replace('_memory_bytes', '')
-                        return {
-                            "tm_received_time": tm_received_time,
-                            "tm_id": int(tm_id),
-                            "parameter": param,
-                            "value": self.clean_value(match.group(1).replace(',', '')),
-                            "processed_at": int(time.time()),
-                            "local_date_time": local_date_time  # Add local date time
-                        }
+        if line[:1] not in MEMORY_LEADS:
+            return None
+        for pattern, param_map in MEMORY_PATTERNS:
+            if match := pattern.match(line):
+                if param := param_map.get(self.current_section):
+                    if str(tm_id).startswith('5'):
+                        param = param.replace('_memory_bytes', '')
+                    return self._record(tm_id, tm_received_time, local_date_time, param,
+                                        self.clean_value(match.group(1).replace(',', '')))
         return None
 
     def _parse_uhf_telemetry(self, line, tm_id, tm_received_time, local_date_time):
         try:
-            str_tm_id = str(tm_id)
-            if str_tm_id not in self.configs.get("uhf", {}):
+            allowed_params = self.index.accepted.get(int(tm_id))
+            if allowed_params is None:
                 return None
-                
-            allowed_params = [p.lower().strip() for p in self.configs["uhf"][str_tm_id]]
             
             if ":" in line:
                 param, value = [x.strip() for x in line.split(":", 1)]
                 clean_param = self.clean_parameter_name(param)
                 if param.lower() in allowed_params or clean_param in allowed_params:
-                    return {
-                        "tm_received_time": tm_received_time,
-                        "tm_id": int(tm_id),
-                        "parameter": clean_param,
-                        "value": self.clean_value(value),
-                        "processed_at": int(time.time()),
-                        "local_date_time": local_date_time  # Add local date time
-                    }
+                    return self._record(tm_id, tm_received_time, local_date_time, clean_param, self.clean_value(value))
                     
             elif "=" in line:
                 param, value = [x.strip() for x in line.split("=", 1)]
                 clean_param = self.clean_parameter_name(param)
                 if param.lower() in allowed_params or clean_param in allowed_params:
-                    return {
-                        "tm_received_time": tm_received_time,
-                        "tm_id": int(tm_id),
-                        "parameter": clean_param,
-                        "value": self.clean_value(value),
-                        "processed_at": int(time.time()),
-                        "local_date_time": local_date_time  # Add local date time
-                    }
-                
-            elif "=>" in line:
-                param, value = [x.strip() for x in line.split("=>", 1)]
-                clean_param = self.clean_parameter_name(param)
-                if param.lower() in allowed_params or clean_param in allowed_params:
-                    return {
-                        "tm_received_time": tm_received_time,
-                        "tm_id": int(tm_id),
-                        "parameter": clean_param,
-                        "value": self.clean_value(value),
-                        "processed_at": int(time.time()),
-                        "local_date_time": local_date_time  # Add local date time
-                    }
-                    
-            elif line.startswith("adc:"):
-                if "adc" in allowed_params:
-                    return {
-                        "tm_received_time": tm_received_time,
-                        "tm_id": int(tm_id),
-                        "parameter": "adc",
-                        "value": self.clean_value(line.split(":")[1]),
-                        "processed_at": int(time.time()),
-                        "local_date_time": local_date_time  # Add local date time
-                    }
+                    return self._record(tm_id, tm_received_time, local_date_time, clean_param, self.clean_value(value))
                     
             elif "UHF RSSI value in dBm is" in line:
                 if "rssi" in allowed_params:
-                    return {
-                        "tm_received_time": tm_received_time,
-                        "tm_id": int(tm_id),
-                        "parameter": "rssi_value_dbm",
-                        "value": self.clean_value(line.split()[-1]),
-                        "processed_at": int(time.time()),
-                        "local_date_time": local_date_time  # Add local date time
-                    }
+                    return self._record(tm_id, tm_received_time, local_date_time, "rssi_value_dbm",
+                                        self.clean_value(line.split()[-1]))
                     
         except Exception as e:
             logger.error(f"Error parsing UHF line '{line}': {e}")
@@ -211,49 +286,47 @@ class TelemetryProcessor:
     def _parse_telemetry_line(self, line, tm_id, tm_received_time, local_date_time):
         if str(tm_id).startswith('8'):
             return self._parse_uhf_telemetry(line, tm_id, tm_received_time, local_date_time)
-            
-        if match := re.match(r"^(\d+)\s*=\s*\[([^\]]+)\]\s*V\s*\[([^\]]+)\]\s*A", line):
-            index, voltage, current = match.groups()
-            prefix = "mppt" if self.current_section == "mppt" else "panel"
-            return [
-                {"tm_received_time": tm_received_time, "tm_id": int(tm_id),
-                 "parameter": f"{prefix}_conv_{index}_voltage", "value": self.clean_value(voltage),
-                 "processed_at": int(time.time()), "local_date_time": local_date_time},
-                {"tm_received_time": tm_received_time, "tm_id": int(tm_id),
-                 "parameter": f"{prefix}_conv_{index}_current", "value": self.clean_value(current),
-                 "processed_at": int(time.time()), "local_date_time": local_date_time}
-            ]
-        elif match := re.match(r"^(\d+)\s*=\s*\[([^\]]+)\]\s*V", line):
-            index, voltage = match.groups()
-            conv_type = "mppt" if self.current_section == "mppt" else "output"
-            return {"tm_received_time": tm_received_time, "tm_id": int(tm_id),
-                    "parameter": f"{conv_type}_conv_{index}_voltage", "value": self.clean_value(voltage),
-                    "processed_at": int(time.time()), "local_date_time": local_date_time}
-        elif match := re.match(r".*Btry temp\s*\[(\d+)\]\s*=\s*\[?([\d.]+)\]?\s*degC", line, re.IGNORECASE):
-            index, temp = match.groups()
-            return {"tm_received_time": tm_received_time, "tm_id": int(tm_id),
-                    "parameter": f"btry_temp_{index}", "value": self.clean_value(temp),
-                    "processed_at": int(time.time()), "local_date_time": local_date_time}
-        elif match := re.match(r"CHNL\[(.+?)\]\s*=>\s*PORT\[(\d+)\]=(\w+)", line):
-            channel, port, status = match.groups()
-            return {"tm_received_time": tm_received_time, "tm_id": int(tm_id),
-                    "parameter": f"{self.clean_parameter_name(channel)}_port_{port}_status", "value": status.strip(),
-                    "processed_at": int(time.time()), "local_date_time": local_date_time}
-        elif "Totl Btry reading" in line and (match := re.search(r"\[\s*(-?[\d.]+)\s*\]\s*V\s*\[\s*(-?[\d.]+)\s*\]\s*A", line)):
+
+        # Each check below is gated on a cheap literal test that any match requires,
+        # so a line only reaches the regexes that can actually match it
+        if line[0].isdigit():
+            if match := CONV_VA_RE.match(line):
+                index, voltage, current = match.groups()
+                prefix = "mppt" if self.current_section == "mppt" else "panel"
+                return [
+                    self._record(tm_id, tm_received_time, local_date_time,
+                                 f"{prefix}_conv_{index}_voltage", self.clean_value(voltage)),
+                    self._record(tm_id, tm_received_time, local_date_time,
+                                 f"{prefix}_conv_{index}_current", self.clean_value(current))
+                ]
+            if match := CONV_V_RE.match(line):
+                index, voltage = match.groups()
+                conv_type = "mppt" if self.current_section == "mppt" else "output"
+                return self._record(tm_id, tm_received_time, local_date_time,
+                                    f"{conv_type}_conv_{index}_voltage", self.clean_value(voltage))
+
+        has_assignment = "=" in line
+        if has_assignment:
+            if "btry temp" in line.lower() and (match := BTRY_TEMP_RE.match(line)):
+                index, temp = match.groups()
+                return self._record(tm_id, tm_received_time, local_date_time,
+                                    f"btry_temp_{index}", self.clean_value(temp))
+            if line.startswith("CHNL[") and (match := CHNL_RE.match(line)):
+                channel, port, status = match.groups()
+                return self._record(tm_id, tm_received_time, local_date_time,
+                                    f"{self.clean_parameter_name(channel)}_port_{port}_status", status.strip())
+        if "Totl Btry reading" in line and (match := TOTL_BTRY_RE.search(line)):
             return [
-                {"tm_received_time": tm_received_time, "tm_id": int(tm_id),
-                 "parameter": "total_battery_voltage", "value": self.clean_value(match.group(1)),
-                 "processed_at": int(time.time()), "local_date_time": local_date_time},
-                {"tm_received_time": tm_received_time, "tm_id": int(tm_id),
-                 "parameter": "total_battery_current", "value": self.clean_value(match.group(2)),
-                 "processed_at": int(time.time()), "local_date_time": local_date_time}
+                self._record(tm_id, tm_received_time, local_date_time,
+                             "total_battery_voltage", self.clean_value(match.group(1))),
+                self._record(tm_id, tm_received_time, local_date_time,
+                             "total_battery_current", self.clean_value(match.group(2)))
             ]
-        elif "=" in line:
+        if has_assignment:
             parts = [p.strip() for p in line.split("=", 1)]
             if len(parts) == 2 and (value := self.clean_value(parts[1])) is not None:
-                return {"tm_received_time": tm_received_time, "tm_id": int(tm_id),
-                        "parameter": self.clean_parameter_name(parts[0]), "value": value,
-                        "processed_at": int(time.time()), "local_date_time": local_date_time}
+                return self._record(tm_id, tm_received_time, local_date_time,
+                                    self.clean_parameter_name(parts[0]), value)
         return None
 
     def parse_line(self, line, tm_id, tm_received_time, local_date_time=None):
@@ -261,173 +334,477 @@ class TelemetryProcessor:
             return None
             
         try:
-            start_time = time.time()
-            tm_received_time = int(float(tm_received_time)) if tm_received_time and str(tm_received_time).strip() else int(time.time())
+            if tm_received_time and tm_received_time == self._last_raw_time:
+                tm_received_time = self._last_time
+            elif tm_received_time and str(tm_received_time).strip():
+                self._last_raw_time = tm_received_time
+                tm_received_time = self._last_time = int(float(tm_received_time))
+            else:
+                tm_received_time = int(time.time())
             line = line.strip()
-            
-            if any(x in line for x in ["Received TM Id:-", "TM Received Time:-", "TM Recv Local Date", "Encryption"]):
-                return None
-
-            if "======" in line:
-                self.current_section = re.sub(r'=+|\s+', '', line).lower()
+            if not line:
                 return None
             
-            if any(s in line for s in ["ERAM MEMORY", "EFLASH QSPI MEMORY", "FLASH FMC MEMORY", 
-                                     "IRAM HEAP MEMORY", "ERAM HEAP MEMORY", "Conv MPPT reading", 
-                                     "Panel reading", "O/P Conv Volt"]):
-                self._update_section_context(line)
+            if is_header_line(line):
                 return None
 
-            if "TM Recv Local Date and Time:-" in line and (match := re.search(r"TM Recv Local Date and Time:-\s*(\d{4}-\d{1,2}-\d{1,2}\s+\d{1,2}:\d{1,2}:\d{1,2})", line)):
-                local_date_time = match.group(1)
-                return None  # Skip, just update local_date_time
+            if "======" in line or SECTION_RE.search(line):
+                self.current_section = self._section_change(line)
+                if self.frame_index:
+                    self.frame_index.sectioned()
+                return None
 
             if memory_data := self._parse_memory_data(line, tm_id, tm_received_time, local_date_time):
-                logger.debug(f"Parsed memory data in {time.time() - start_time:.3f}s: {memory_data}")
+                if self._debug:
+                    logger.debug("Parsed memory data: %s", memory_data)
                 return memory_data
                 
             parsed = self._parse_telemetry_line(line, tm_id, tm_received_time, local_date_time)
-            logger.debug(f"Parsed telemetry in {time.time() - start_time:.3f}s: {parsed}")
+            if self._debug:
+                logger.debug("Parsed telemetry: %s", parsed)
             return parsed
             
         except Exception as e:
             logger.error(f"Error parsing line '{line}': {e}")
             return None
 
+    def parse_stream(self, lines):
+        # Frame context lives on the parser so a frame split across two reads
+        # keeps its tm_id, time and local date. The debug level is read once per
+        # stream so disabled debug logging costs nothing per line.
+        debug = self._debug = logger.isEnabledFor(logging.DEBUG)
+        frame_index = self.frame_index
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+
+            if "Received TM Id:-" in line and (match := TM_ID_RE.search(line)):
+                self.current_tm_id = int(match.group(1))
+                if frame_index:
+                    frame_index.start(self.current_tm_id)
+                if debug:
+                    logger.debug("Found TM ID: %s", self.current_tm_id)
+            elif "TM Received Time:-" in line and (match := TM_TIME_RE.search(line)):
+                self.current_tm_time = match.group(1)
+                if frame_index:
+                    frame_index.timed(self.current_tm_time)
+                if debug:
+                    logger.debug("Found TM Time: %s", self.current_tm_time)
+            elif "TM Recv Local Date and Time:-" in line and (match := LOCAL_TIME_RE.search(line)):
+                self.current_local_time = match.group(1)
+                if frame_index:
+                    frame_index.dated()
+                if debug:
+                    logger.debug("Found Local Date Time: %s", self.current_local_time)
+            elif not self.current_tm_id:
+                continue
+            elif self.current_tm_id not in self.index.routes:
+                # Frames no config accepts are skipped without parsing; only the
+                # section context they change is kept
+                if not is_header_line(line) and ("======" in line or SECTION_RE.search(line)):
+                    self.current_section = self._section_change(line)
+                    if frame_index:
+                        frame_index.sectioned()
+            elif parsed := self.parse_line(line, self.current_tm_id, self.current_tm_time, self.current_local_time):
+                if isinstance(parsed, list):
+                    yield from parsed
+                else:
+                    yield parsed
+
+class IngestPipeline:
+    """Writer, notifier, rollup, archive and limit stages shared by every log the process follows.
+
+    With a `spool` the writer takes its batches from it, and `client` finds the
+    collections of batches an earlier run left there.
+    """
+
+    def __init__(self, notification_url=None, layout=None, client=None, spool=None):
+        self.layout = layout or LAYOUTS[STORAGE_LAYOUT]
+        self.spool = spool
+        self.readers = []
+        self.indexed = set()
+        self.notifier = BackendNotifier(notification_url or NOTIFICATION_URL).start()
+        self.rollups = RollupAggregator(self.layout).start()
+        self.last_values = LastValueCache()
+        self.archive = ArchiveWriter(os.path.join(ARCHIVE_DIR, time.strftime("%Y%m%d-%H%M%S"))) if ARCHIVE_DIR else None
+        self.limits = LimitMonitor(self._notify_events, list(COLLECTION_MAPPING)) if LIMIT_CHECKS else None
+        self.writer = BulkWriter(on_written=self._notify_backend, on_stored=self._on_stored,
+                                 layout=self.layout, cache=self.last_values, spool=spool,
+                                 resolve=lambda database, name: client[database][name]).start()
+        metrics.gauge("writer_queue_depth", self.writer.backlog)
+        metrics.gauge("notifier_queue_depth", self.notifier.queue.qsize)
+        metrics.gauge("writer_batch_size", lambda: self.writer.batch_size)
+        metrics.gauge("writer_healthy", lambda: int(self.writer.healthy()))
+        metrics.gauge("last_value_cache_size", lambda: len(self.last_values))
+        metrics.gauge("file_lag_bytes", self._file_lag)
+        if spool is not None:
+            metrics.gauge("spool_bytes", spool.size)
+
+    def close(self):
+        self.writer.close()
+        self.rollups.close()
+        if self.archive:
+            self.archive.close()
+        self.notifier.close()
+
+    def _file_lag(self):
+        lag = 0
+        for reader in list(self.readers):
+            try:
+                lag += max(0, reader.size() - reader.offset)
+            except OSError:
+                pass
+        return lag
+
     def _notify_backend(self, collection, items):
+        self.notifier.notify(collection.name, items, collection.database.name)
+
+    def _notify_events(self, database, collection, events):
+        self.notifier.notify_events(collection, events, database)
+
+    def _on_stored(self, collection, items, created, changed):
+        # Rollups and archive columns are named after the per-parameter collection whatever the storage layout
+        name = collection.name.removesuffix(self.layout.suffix)
+        self.rollups.add(collection.database, name, created, changed, collection)
+        if self.archive:
+            self.archive.add(collection.database.name, name, items)
+
+class TelemetryProcessor(TelemetryParser):
+    def __init__(self, log_file=None, client=None, notification_url=None, from_start=False,
+                 database=None, pipeline=None, configs=None, state=None):
+        # `client` and `pipeline` let several processors share one connection pool
+        # and one set of background stages; a processor only closes what it created.
+        # `state` is a checkpoint() of an earlier run to resume from
+        self.log_file = log_file = log_file or LOG_FILE
+        self._owns_client = client is None
+        self.client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000) if client is None else client
+        self.db = self.client[database or DATABASE_NAME]
+        if state:
+            start = state["offset"]
+        else:
+            start = 0 if from_start or not os.path.exists(log_file) else os.path.getsize(log_file)
+        self.reader = LogTailReader(log_file, start)
+        self._process_lock = threading.Lock()
+        super().__init__(configs)
+        if state:
+            self.restore_parser_state(state)
+        self._frame_lines = state.get("frame_lines") if state else None
+        self._owns_pipeline = pipeline is None
+        self.pipeline = pipeline or IngestPipeline(notification_url)
+        self.layout = self.pipeline.layout
+        self._ensure_indexes()
+        self.pipeline.readers.append(self.reader)
+        self.writer = self.pipeline.writer
+        self.notifier = self.pipeline.notifier
+        self.rollups = self.pipeline.rollups
+
+    def close(self):
+        self.pipeline.readers.remove(self.reader)
+        if self.frame_index:
+            self.frame_index.close()
+        if self._owns_pipeline:
+            self.pipeline.close()
+        if self._owns_client:
+            self.client.close()
+
+    @property
+    def last_position(self):
+        return self.reader.offset
+
+    @last_position.setter
+    def last_position(self, offset):
+        self.reader.reset(offset)
+
+    def checkpoint(self):
+        # Everything before the offset has been handed to the writer
+        with self._process_lock:
+            state = {"offset": self.last_position, **self.parser_state()}
+            if self.frame_index:
+                state["frame_lines"] = self.frame_index.lines()
+            return state
+
+    def _open_frame_index(self):
+        # Opened once the log exists; False after a failure so it isn't retried every read
         try:
-            start_time = time.time()
-            response = requests.post(NOTIFICATION_URL, json={"collection": collection, "data": items}, timeout=2)
-            if response.status_code != 200:
-                logger.warning(f"Notification failed for {collection}: Status {response.status_code}")
-            else:
-                logger.debug(f"Notified backend for {collection} in {time.time() - start_time:.3f}s")
-        except Exception as e:
-            logger.error(f"Could not send notification for {collection}: {e}")
+            self.frame_index = FrameIndexWriter(index_path(self.log_file), self.reader, self.current_tm_time,
+                                                self._frame_lines)
+        except OSError as e:
+            logger.error(f"No frame index for {self.log_file}: {e}")
+            self.frame_index = False
+
+    def _collection(self, category):
+        return self.db[COLLECTION_MAPPING[category] + self.layout.suffix]
+
+    def _ensure_indexes(self):
+        indexed = self.pipeline.indexed
+        for category in COLLECTION_MAPPING:
+            collection = self._collection(category)
+            if collection.full_name in indexed:
+                continue
+            try:
+                ensure_indexes(collection, self.layout)
+                indexed.add(collection.full_name)
+            except Exception as e:
+                logger.error(f"Index error for {collection.name}: {e}")
 
-    def process_file(self):
+    def process_file(self, max_bytes=None):
+        # Reads must never overlap: they share the reader offset and parser state
+        with self._process_lock:
+            return self._process_file(max_bytes)
+
+    def _process_file(self, max_bytes=None):
         try:
-            if not os.path.exists(LOG_FILE):
-                logger.warning(f"Log file not found: {LOG_FILE}")
+            self.reload_configs_if_changed()
+            if not os.path.exists(self.log_file):
+                logger.warning(f"Log file not found: {self.log_file}")
                 return False
+            if FRAME_INDEX and self.frame_index is None:
+                self._open_frame_index()
 
-            with open(LOG_FILE, 'r') as f:
-                start_time = time.time()
-                current_size = os.path.getsize(LOG_FILE)
-                if current_size < self.last_position:
-                    logger.info("Log file truncated, resetting position")
-                    self.last_position = 0
-                elif current_size == self.last_position:
-                    return False
-                
-                f.seek(self.last_position)
-                data = f.read()
-                if not data:
-                    return False
-                    
-                logger.info(f"Processing {len(data.splitlines())} new lines")
-                
-                tm_id = tm_received_time = local_date_time = None
-                batch = []
-                
-                for line in data.splitlines():
-                    line = line.strip()
-                    if not line:
-                        continue
-                    
-                    if "Received TM Id:-" in line and (match := re.search(r"Received TM Id:-\s*(\d+)", line)):
-                        tm_id = int(match.group(1))
-                        logger.debug(f"Found TM ID: {tm_id}")
-                    elif "TM Received Time:-" in line and (match := re.search(r"TM Received Time:-\s*(\d+)", line)):
-                        tm_received_time = match.group(1)
-                        logger.debug(f"Found TM Time: {tm_received_time}")
-                    elif "TM Recv Local Date and Time:-" in line and (match := re.search(r"TM Recv Local Date and Time:-\s*(\d{4}-\d{1,2}-\d{1,2}\s+\d{1,2}:\d{1,2}:\d{1,2})", line)):
-                        local_date_time = match.group(1)
-                        logger.debug(f"Found Local Date Time: {local_date_time}")
-                    elif tm_id and (parsed := self.parse_line(line, tm_id, tm_received_time, local_date_time)):
-                        if isinstance(parsed, list):
-                            batch.extend(parsed)
-                        else:
-                            batch.append(parsed)
-                        logger.debug(f"Parsed line: {line}")
-                
-                self.last_position = f.tell()
-                
-                if batch:
-                    logger.info(f"Processing batch of {len(batch)} items")
-                    categorized = {k: [] for k in COLLECTION_MAPPING}
-                    
-                    for item in batch:
-                        tm_id = item['tm_id']
-                        if 200 <= tm_id <= 300:
-                            categorized["eps"].append(item)
-                        elif 500 <= tm_id <= 650:
-                            categorized["obc"].append(item)
-                        elif 800 <= tm_id <= 900:
-                            categorized["uhf"].append(item)
-                        else:
-                            logger.warning(f"Unknown TM ID range for ID {tm_id}")
-                    
-                    for category, items in categorized.items():
-                        if items:
-                            try:
-                                logger.info(f"Processing {len(items)} items for {category}")
-                                collection = COLLECTION_MAPPING[category]
-                                
-                                if self.configs and category in self.configs:
-                                    valid_tm_ids = self.configs[category].keys()
-                                    items = [i for i in items if str(i['tm_id']) in valid_tm_ids]
-                                
-                                if items:
-                                    batch_start = time.time()
-                                    for i in range(0, len(items), 100):  # Limit batch size
-                                        batch_items = items[i:i+100]
-                                        result = self.db[collection].bulk_write(
-                                            [UpdateOne(
-                                                {"tm_received_time": item["tm_received_time"], 
-                                                 "tm_id": item["tm_id"], 
-                                                 "parameter": item["parameter"]},
-                                                {"$set": item}, upsert=True) for item in batch_items],
-                                            ordered=False
-                                        )
-                                        logger.info(f"{category.upper()}: Inserted {result.upserted_count}, Modified {result.modified_count} in {time.time() - batch_start:.3f}s")
-                                    self._notify_backend(collection, items)
-                            except Exception as e:
-                                logger.error(f"Bulk write error for {category}: {e}")
-                    logger.info(f"Total processing time: {time.time() - start_time:.3f}s")
-                    return True
+            start_time = time.time()
+            current_size = self.reader.size()
+            if current_size < self.reader.read_position:
+                logger.info("Log file truncated, resetting position")
+                self.last_position = 0
+                # The new content starts without the section and frame the old one ended in
+                self.restore_parser_state({})
+                if self.frame_index:
+                    self.frame_index.reset()
+            elif current_size == self.reader.read_position:
                 return False
+
+            start_offset = self.last_position
+            read_seconds, lines_read = self.reader.read_seconds, self.reader.lines_read
+            stored = False
+            batch = []
+            records = 0
+            store_seconds = 0.0
+            read_time = time.monotonic()
+            loop_start = time.perf_counter()
+            limit = None if max_bytes is None else self.reader.read_position + max_bytes
+            for record in self.parse_stream(self.reader.lines(limit)):
+                batch.append(record)
+                if len(batch) >= FLUSH_BATCH_SIZE:
+                    records += len(batch)
+                    started = time.perf_counter()
+                    stored = self._store_batch(batch, read_time=read_time) or stored
+                    store_seconds += time.perf_counter() - started
+                    batch = []
+                    read_time = time.monotonic()
+            if batch:
+                records += len(batch)
+                started = time.perf_counter()
+                stored = self._store_batch(batch, read_time=read_time) or stored
+                store_seconds += time.perf_counter() - started
+            if self.frame_index:
+                self.frame_index.flush()
+
+            # Reading and parsing interleave in one loop; parse time is what is left
+            # after the reader's own I/O time and the hand-off to the writer
+            read_seconds = self.reader.read_seconds - read_seconds
+            metrics.observe("read", read_seconds)
+            metrics.observe("parse", time.perf_counter() - loop_start - read_seconds - store_seconds)
+            metrics.inc("bytes_read", self.last_position - start_offset)
+            metrics.inc("lines_read", self.reader.lines_read - lines_read)
+            metrics.inc("records_parsed", records)
+
+            if stored:
+                logger.info(f"Processed {self.last_position - start_offset} bytes in {time.time() - start_time:.3f}s")
+            return stored
         except Exception as e:
             logger.error(f"File processing error: {e}")
             return False
 
-class TelemetryFileHandler(FileSystemEventHandler):
-    def __init__(self, processor):
-        self.processor = processor
-    
-    def on_modified(self, event):
-        if event.src_path == LOG_FILE:
-            self.processor.process_file()
+    def _store_batch(self, batch, notify=True, read_time=None):
+        # Routes records to their collections and hands them to the background writer,
+        # which blocks here only when it is too far behind
+        logger.debug("Routing batch of %d items", len(batch))
+        started = time.perf_counter()
+        categorized = {}
+        routes = self.index.routes
+        for item in batch:
+            if (category := routes.get(item['tm_id'])) is not None:
+                categorized.setdefault(category, []).append(item)
+            else:
+                metrics.inc("records_unrouted")
+                logger.warning(f"No config accepts TM ID {item['tm_id']}")
+        metrics.observe("route", time.perf_counter() - started)
+
+        limits = self.pipeline.limits
+        if notify and limits:
+            # Checked before the write so alerts don't wait for Mongo or the spool; events are
+            # sent for the collection the data notifications name, whatever the storage layout
+            started = time.perf_counter()
+            for category, items in categorized.items():
+                limits.check(self.db.name, self._collection(category).name, category, items)
+            metrics.observe("limits", time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for category, items in categorized.items():
+            self.writer.put(self._collection(category), items, notify, read_time)
+            metrics.inc("records_routed", len(items))
+        metrics.observe("writer_backpressure", time.perf_counter() - started)
+        return True
+
+class IngestService:
+    """Follows every log matched by SOURCES from one process.
+
+    All logs share one MongoClient and one IngestPipeline; each file keeps its
+    own reader and parser state. A round gives each file at most `turn_bytes`,
+    starting one file further along every time, so a busy log can't starve the
+    others. Glob matches that appear after startup are read from the beginning.
+
+    Records pass through the spool in `spool_dir`. The checkpoint saved next to
+    it pairs every log's offset and parser state with the last spooled batch, so
+    a restart drops anything spooled after the checkpoint and re-reads it from
+    the logs, while batches before it are written from the spool.
+    """
+
+    def __init__(self, sources=None, client=None, notification_url=None, turn_bytes=TURN_BYTES, spool_dir=None):
+        self.sources = sources or SOURCES
+        self.turn_bytes = turn_bytes
+        self._owns_client = client is None
+        self.client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000) if client is None else client
+        self.config_source = TelemetryParser()
+        spool_dir = spool_dir or SPOOL_DIR
+        self.spool = RecordSpool(spool_dir) if spool_dir else None
+        self._checkpoint_path = os.path.join(spool_dir, "checkpoint.json") if spool_dir else None
+        self._resume = (read_json(self._checkpoint_path) if self.spool else None) or {}
+        if self._resume:
+            self.spool.truncate_after(self._resume["spool_seq"])
+        self.pipeline = IngestPipeline(notification_url, client=self.client, spool=self.spool)
+        self.processors = {}
+        self._turn = 0
+        self._next_scan = 0
+        self._next_checkpoint = 0
+        self.scan_sources(initial=True)
+
+    @property
+    def configs(self):
+        return self.config_source.configs
+
+    def close(self):
+        self.save_checkpoint()
+        for processor in self.processors.values():
+            processor.close()
+        self.processors.clear()
+        self.pipeline.close()
+        if self.spool:
+            self.spool.close()
+        if self._owns_client:
+            self.client.close()
+
+    def scan_sources(self, initial=False):
+        self._next_scan = time.monotonic() + SOURCE_SCAN_INTERVAL
+        matched = set()
+        for source in self.sources:
+            pattern = source["path"]
+            paths = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+            for path in map(os.path.abspath, paths):
+                matched.add(path)
+                if path in self.processors:
+                    continue
+                state = self._resume.get("sources", {}).pop(path, None)
+                self.processors[path] = TelemetryProcessor(
+                    path, self.client, from_start=not initial and glob.has_magic(pattern),
+                    database=source.get("database"), pipeline=self.pipeline, configs=self.config_source.index,
+                    state=state)
+                logger.info(f"Following {path} into {source.get('database') or DATABASE_NAME}"
+                            + (f" from offset {state['offset']}" if state else ""))
+        for path in [p for p in self.processors if p not in matched]:
+            # Only glob matches can disappear; plain paths are kept while they are missing
+            logger.info(f"Stopped following {path}")
+            self.processors.pop(path).close()
+
+    def _refresh(self):
+        if self.config_source.reload_configs_if_changed():
+            for processor in self.processors.values():
+                processor.index = self.config_source.index
+        if time.monotonic() >= self._next_scan:
+            self.scan_sources()
+
+    def has_new_data(self):
+        self._refresh()
+        for processor in list(self.processors.values()):
+            try:
+                if processor.reader.has_new_data():
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def process_round(self):
+        processors = list(self.processors.values())
+        if not processors:
+            return False
+        first = self._turn % len(processors)
+        self._turn += 1
+        stored = False
+        for processor in processors[first:] + processors[:first]:
+            stored = processor.process_file(self.turn_bytes) or stored
+        if time.monotonic() >= self._next_checkpoint:
+            self.save_checkpoint()
+        return stored
+
+    def save_checkpoint(self):
+        if not self.spool:
+            return
+        self._next_checkpoint = time.monotonic() + CHECKPOINT_INTERVAL
+        try:
+            sources = {path: processor.checkpoint() for path, processor in self.processors.items()}
+            # The spool must be on disk before a checkpoint that points past it
+            self.spool.sync()
+            write_json_atomic(self._checkpoint_path, {"spool_seq": self.spool.next_seq - 1, "sources": sources})
+        except Exception as e:
+            logger.error(f"Checkpoint error: {e}")
+
+    def latest_values(self, query):
+        tm_id = query.get("tm_id")
+        return self.pipeline.last_values.snapshot(query.get("database"), query.get("collection"),
+                                                  int(tm_id) if tm_id else None, query.get("parameter"))
+
+    def rolling_stats(self, query):
+        if not self.pipeline.limits:
+            return []
+        tm_id = query.get("tm_id")
+        return self.pipeline.limits.snapshot(query.get("database"), query.get("collection"),
+                                             int(tm_id) if tm_id else None, query.get("parameter"))
+
+    def watched_directories(self):
+        directories = {os.path.dirname(path) for path in self.processors}
+        directories.update(os.path.dirname(os.path.abspath(source["path"])) for source in self.sources)
+        return sorted(d for d in directories if os.path.isdir(d))
 
 def main():
     logger.info("Telemetry Processor - Real-Time Monitoring")
-    processor = TelemetryProcessor()
+    service = IngestService()
+    metrics_server = None
+    if METRICS_PORT:
+        try:
+            routes = {"/latest": service.latest_values, "/stats": service.rolling_stats}
+            metrics_server = MetricsServer(METRICS_PORT, routes=routes).start()
+        except OSError as e:
+            logger.error(f"Could not serve metrics on port {METRICS_PORT}: {e}")
     
-    if processor.configs:
-        processor.process_file()
+    if service.configs:
+        service.process_round()
+        scheduler = FileWatchScheduler([source["path"] for source in service.sources],
+                                       service.process_round, service.has_new_data)
         observer = Observer()
-        observer.schedule(TelemetryFileHandler(processor), path=os.path.dirname(LOG_FILE))
+        for directory in service.watched_directories():
+            observer.schedule(scheduler, path=directory)
         observer.start()
         
         try:
-            while True:
-                time.sleep(0.1)  # Reduced polling interval
-                if os.path.getsize(LOG_FILE) > processor.last_position:
-                    processor.process_file()
+            scheduler.run()
         except KeyboardInterrupt:
-            observer.stop()
+            scheduler.stop()
+        observer.stop()
         observer.join()
-        processor.client.close()
+    service.close()
+    if metrics_server:
+        metrics_server.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(PYTHON_DIR, "tests", "data")
+SAMPLE_LOG = os.path.join(DATA_DIR, "sample.log")
+GOLDEN_FILE = os.path.join(DATA_DIR, "sample_records.json")
+
+sys.path.insert(0, PYTHON_DIR)
+
+import benchmark
+import telemetry_parser
+from telemetry_parser import TelemetryParser, TelemetryProcessor
+
+def parse_sample():
+    # Configs are read from the working directory, like the ingester does
+    cwd = os.getcwd()
+    os.chdir(PYTHON_DIR)
+    try:
+        parser = TelemetryParser()
+        with open(SAMPLE_LOG) as f:
+            records = list(parser.parse_stream(f))
+    finally:
+        os.chdir(cwd)
+    for record in records:
+        del record["processed_at"]
+    return records
+
+def test_parse_stream_matches_golden_output():
+    with open(GOLDEN_FILE) as f:
+        expected = json.load(f)
+    records = parse_sample()
+    assert len(records) == len(expected)
+    for i, (record, golden) in enumerate(zip(records, expected)):
+        assert record == golden, f"record {i} differs"
+        assert type(record["value"]) is type(golden["value"]), f"record {i} value type differs"
+
+def test_sample_covers_every_subsystem_and_unrouted_frames():
+    tm_ids = {record["tm_id"] for record in parse_sample()}
+    assert {200, 500, 501, 800, 819} <= tm_ids
+    assert not tm_ids & {999, 700}
+    with open(SAMPLE_LOG) as f:
+        frame_ids = {int(line.split(":-")[1]) for line in f if line.startswith("Received TM Id:-")}
+    assert {999, 700} <= frame_ids
+
+def test_truncated_log_does_not_continue_the_old_frame(tmp_path, monkeypatch):
+    monkeypatch.chdir(PYTHON_DIR)
+    monkeypatch.setattr(telemetry_parser.IngestPipeline, "_notify_backend", lambda self, collection, items: None)
+    monkeypatch.setattr(telemetry_parser.IngestPipeline, "_notify_events", lambda self, *args: None)
+    log = tmp_path / "live.log"
+    log.write_text("Received TM Id:- 200\nTM Received Time:- 1695712345\n"
+                   "TM Recv Local Date and Time:- 2023-09-26 10:00:00\nPanel reading\n0 = [2.36]V [0.522]A\n" + "#" * 200 + "\n")
+    client = benchmark.MemoryClient()
+    processor = TelemetryProcessor(str(log), client, from_start=True, database="x")
+    processor.process_file()
+    # Rewritten from the start with a line that belongs to no frame
+    log.write_text("1 = [2.0]V [0.2]A\n")
+    processor.process_file()
+    processor.close()
+    values = sorted(document["value"] for document in client["x"]["eps_telemetry"].documents.values())
+    assert values == [0.522, 2.36]
+
+if __name__ == "__main__":
+    # Regenerates the golden file after an intended change to the parser output
+    with open(GOLDEN_FILE, "w") as f:
+        json.dump(parse_sample(), f, indent=1)
+        f.write("\n")
+    print(f"Wrote {GOLDEN_FILE}")
@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, PYTHON_DIR)
+
+from pymongo.errors import OperationFailure, ServerSelectionTimeoutError
+import benchmark
+import telemetry_parser
+from bulk_writer import BulkWriter
+from spool import RECORD_HEADER, RecordSpool
+from telemetry_parser import IngestService, TelemetryProcessor
+
+def record(t, parameter, value=1.0):
+    return {"tm_received_time": t, "tm_id": 200, "parameter": parameter, "value": value,
+            "processed_at": 0, "local_date_time": "2023-09-26 10:00:00"}
+
+def stored(client):
+    return {name: {key: {field: value for field, value in document.items() if field != "processed_at"}
+                   for key, document in collection.documents.items()}
+            for name, collection in client["x"].items() if "_rollup_" not in name}
+
+def quiet_pipeline(monkeypatch):
+    # Configs are read from the working directory and nothing listens for notifications
+    monkeypatch.chdir(PYTHON_DIR)
+    monkeypatch.setattr(telemetry_parser.IngestPipeline, "_notify_backend", lambda self, collection, items: None)
+    monkeypatch.setattr(telemetry_parser.IngestPipeline, "_notify_events", lambda self, *args: None)
+
+def drain(service):
+    while service.has_new_data():
+        service.process_round()
+
+def test_outage_and_restart_lose_nothing(tmp_path, monkeypatch):
+    quiet_pipeline(monkeypatch)
+    source = tmp_path / "source.log"
+    benchmark.generate_log(str(source), 600, seed=3)
+    data = source.read_bytes()
+    cut = data.index(b"\n", len(data) // 2) + 1
+    live = tmp_path / "live.log"
+    live.write_bytes(b"")
+
+    down = [True]
+    write = benchmark.MemoryCollection.bulk_write
+    def bulk_write(self, *args, **kwargs):
+        if down[0]:
+            raise ServerSelectionTimeoutError("mongod is down")
+        return write(self, *args, **kwargs)
+    monkeypatch.setattr(benchmark.MemoryCollection, "bulk_write", bulk_write)
+
+    client = benchmark.MemoryClient()
+    sources = [{"path": str(live), "database": "x"}]
+    service = IngestService(sources, client, spool_dir=str(tmp_path / "spool"))
+    # A new log is followed from its end, so the data arrives after the start
+    with open(live, "ab") as f:
+        f.write(data[:cut])
+    drain(service)
+    service.save_checkpoint()
+    assert not stored(client)["eps_telemetry"]
+    assert service.spool.pending()
+
+    # The process dies while Mongo is down: nothing is drained or closed
+    writer = service.pipeline.writer
+    writer._closing.set()
+    writer._thread.join()
+    down[0] = False
+
+    with open(live, "ab") as f:
+        f.write(data[cut:])
+    restarted = IngestService(sources, client, spool_dir=str(tmp_path / "spool"))
+    drain(restarted)
+    restarted.close()
+    assert restarted.spool.pending() == 0
+
+    reference = benchmark.MemoryClient()
+    processor = TelemetryProcessor(str(source), reference, from_start=True, database="x")
+    processor.process_file()
+    processor.close()
+    assert stored(client) == stored(reference)
+
+def test_damaged_spool_record_is_skipped(tmp_path):
+    spool = RecordSpool(str(tmp_path))
+    for i in range(1, 4):
+        spool.append("x", "eps_telemetry", [record(i, f"p{i}")])
+    spool.close()
+    segment = next(name for name in os.listdir(tmp_path) if name.endswith(".seg"))
+    with open(tmp_path / segment, "r+b") as f:
+        _, length, _ = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        # Corrupts the payload of the second batch
+        f.seek(2 * RECORD_HEADER.size + length + 4)
+        f.write(b"\xff\xff\xff\xff")
+
+    client = benchmark.MemoryClient()
+    spool = RecordSpool(str(tmp_path))
+    writer = BulkWriter(spool=spool, resolve=lambda database, name: client[database][name], flush_interval=0.01).start()
+    deadline = time.monotonic() + 5
+    while spool.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writer.healthy()
+    writer.close()
+    spool.close()
+    assert sorted(document["parameter"] for document in client["x"]["eps_telemetry"].documents.values()) == ["p1", "p3"]
+    assert spool.pending() == 0
+
+def test_rejected_batch_is_quarantined(tmp_path, monkeypatch):
+    write = benchmark.MemoryCollection.bulk_write
+    def bulk_write(self, *args, **kwargs):
+        if self.name == "obc_telemetry":
+            raise OperationFailure("Document failed validation", 121)
+        return write(self, *args, **kwargs)
+    monkeypatch.setattr(benchmark.MemoryCollection, "bulk_write", bulk_write)
+
+    client = benchmark.MemoryClient()
+    spool = RecordSpool(str(tmp_path))
+    writer = BulkWriter(spool=spool, resolve=lambda database, name: client[database][name], flush_interval=0.01).start()
+    writer.put(client["x"]["obc_telemetry"], [record(1, "rejected")])
+    writer.put(client["x"]["eps_telemetry"], [record(2, "kept")])
+    deadline = time.monotonic() + 5
+    while spool.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.close()
+    assert [document["parameter"] for document in client["x"]["eps_telemetry"].documents.values()] == ["kept"]
+    assert [(collection, [item["parameter"] for item in items], error)
+            for _, collection, items, error, _ in spool.quarantined()] == [
+        ("obc_telemetry", ["rejected"], "Document failed validation")]
+    spool.close()
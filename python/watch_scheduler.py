@@ -0,0 +1,65 @@
+import fnmatch
+import logging
+import os
+import threading
+from watchdog.events import FileSystemEventHandler
+
+DEBOUNCE = 0.05     # seconds to let a burst of writes settle before reading
+MIN_POLL = 0.1      # fallback poll interval while data is flowing
+MAX_POLL = 2.0      # fallback poll interval once the file has gone idle
+
+logger = logging.getLogger(__name__)
+
+class FileWatchScheduler(FileSystemEventHandler):
+    """Runs `process` for the watched log files from a single consumer loop.
+
+    Filesystem events and the fallback poll only wake the loop; they never call
+    `process` themselves, so two reads of the same file can't overlap. The poll
+    interval doubles while the files are idle and snaps back once data arrives;
+    while a read leaves data behind the loop goes round again without waiting.
+    `paths` is a path or glob, or a list of them.
+    """
+
+    def __init__(self, paths, process, has_new_data, debounce=DEBOUNCE, min_poll=MIN_POLL, max_poll=MAX_POLL):
+        self.patterns = [os.path.abspath(p) for p in ([paths] if isinstance(paths, str) else paths)]
+        self.process = process
+        self.has_new_data = has_new_data
+        self.debounce = debounce
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.stopped = threading.Event()
+        self._wake = threading.Event()
+
+    def _matches(self, path):
+        path = os.path.abspath(path)
+        return any(path == pattern or fnmatch.fnmatch(path, pattern) for pattern in self.patterns)
+
+    def on_any_event(self, event):
+        if self._matches(event.src_path) or (getattr(event, "dest_path", "") and self._matches(event.dest_path)):
+            self._wake.set()
+
+    def _pending(self):
+        try:
+            return self.has_new_data()
+        except OSError as e:
+            logger.debug("Cannot stat %s: %s", ", ".join(self.patterns), e)
+            return False
+
+    def stop(self):
+        self.stopped.set()
+        self._wake.set()
+
+    def run(self):
+        interval = self.min_poll
+        while not self.stopped.is_set():
+            if self._wake.wait(interval):
+                # Coalesce the burst of events a single append produces
+                self.stopped.wait(self.debounce)
+                self._wake.clear()
+            if self.stopped.is_set():
+                break
+            if self._pending():
+                self.process()
+                interval = 0 if self._pending() else self.min_poll
+            else:
+                interval = min(self.max_poll, max(self.min_poll, interval * 2))
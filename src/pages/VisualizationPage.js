@@ -21,6 +21,8 @@ const VisualizationPage = () => {
   const [showInsights, setShowInsights] = useState(false);
   const [isFullScreen, setIsFullScreen] = useState(false);
   const [textValueMappings, setTextValueMappings] = useState({});
+  const [liveStats, setLiveStats] = useState({});
+  const [alerts, setAlerts] = useState({});
 
   // Check if a parameter is text-based
   const isTextParam = (param) => {
@@ -109,7 +111,7 @@ const VisualizationPage = () => {
 
     const fetchInitialData = async () => {
       try {
-        const response = await fetch(`http://localhost:4000/api/telemetry?collection=${collection}`);
+        const response = await fetch(`http://localhost:4000/api/telemetry?collection=${collection}&dbName=${dbName}`);
         const data = await response.json();
         console.log("Raw API response:", data);
         setRawData(data);
@@ -120,7 +122,7 @@ const VisualizationPage = () => {
 
     fetchInitialData();
 
-    const eventSource = new EventSource(`http://localhost:4000/api/telemetry/updates?collection=${collection}`);
+    const eventSource = new EventSource(`http://localhost:4000/api/telemetry/updates?collection=${collection}&dbName=${dbName}`);
 
     eventSource.onmessage = (event) => {
       if (event.data === ":ping") return;
@@ -142,6 +144,17 @@ const VisualizationPage = () => {
       }
     };
 
+    // Rolling statistics and limit alerts computed by the ingester as values arrive
+    eventSource.addEventListener("stats", (event) => {
+      const stats = JSON.parse(event.data);
+      setLiveStats((prev) => ({ ...prev, [stats.parameter]: stats }));
+    });
+
+    eventSource.addEventListener("alert", (event) => {
+      const alert = JSON.parse(event.data);
+      setAlerts((prev) => ({ ...prev, [`${alert.parameter}/${alert.check}`]: alert }));
+    });
+
     eventSource.onerror = (error) => {
       console.error("SSE connection error:", error);
     };
@@ -260,6 +273,15 @@ const VisualizationPage = () => {
   const handleDrawInsights = () => {
     const insights = [];
 
+    Object.values(alerts)
+      .filter((alert) => alert.state !== "ok")
+      .forEach((alert) => {
+        const limit = alert.check === "slope"
+          ? `slope ${alert.slope.toFixed(3)}/s, limit ±${alert.max_slope}`
+          : `limits ${alert.min ?? "-"} .. ${alert.max ?? "-"}`;
+        insights.push(`ALERT ${alert.parameter} ${alert.state}: ${alert.value} (${limit})`);
+      });
+
     parameters
       .filter((p) => !isTextParam(p))
       .forEach((param) => {
@@ -275,6 +297,12 @@ const VisualizationPage = () => {
             insights.push(`${param}: Min ${min.toFixed(2)}, Max ${max.toFixed(2)}, Avg ${avg.toFixed(2)}`);
           }
         }
+
+        const live = liveStats[param];
+        if (live) {
+          insights.push(`${param} (last ${live.n} live): Mean ${live.mean.toFixed(2)}, Std ${live.std.toFixed(2)}, ` +
+                        `Min ${live.min.toFixed(2)}, Max ${live.max.toFixed(2)}, Slope ${live.slope.toFixed(4)}/s`);
+        }
       });
 
     parameters.filter(isTextParam).forEach((param) => {